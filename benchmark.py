@@ -0,0 +1,276 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+from compactsession import CompactSession
+from sortingmanager import SortingManager
+
+# Headless benchmarks of the sorting engine, the layout engines and the row
+# optimiser.  Sorting is driven by an oracle that answers every comparison
+# from a hidden ranking, so the timings cover the engine and nothing else.
+# Results are written as JSON so runs can be compared over time.  numpy,
+# scipy and PIL are only imported by the benchmarks that need them, so the
+# sorting benchmark runs without them.
+
+
+def summarise(samples):
+    """Return latency percentiles of samples in seconds, as microseconds."""
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return 1e6 * ordered[min(int(fraction * len(ordered)),
+                                 len(ordered) - 1)]
+
+    return {'count': len(ordered),
+            'mean_us': 1e6 * sum(ordered) / len(ordered),
+            'p50_us': percentile(0.50),
+            'p90_us': percentile(0.90),
+            'p99_us': percentile(0.99),
+            'max_us': 1e6 * ordered[-1]}
+
+
+def make_session(number_of_elements, seed, compact):
+    # Paths carry their rank, the oracle reads it back out of them
+    random_state = random.Random(seed)
+    ranks = list(range(number_of_elements))
+    random_state.shuffle(ranks)
+    paths = ['images/{:09d}.jpg'.format(rank) for rank in ranks]
+    if compact:
+        return CompactSession(paths)
+    session = deque(deque([path]) for path in paths)
+    session.appendleft(deque())
+    return session
+
+
+def oracle(options):
+    return 0 if options[0] < options[1] else 1
+
+
+def run_sort(number_of_elements, seed, compact, manager_options, undo_rate,
+             max_decisions, timed):
+    """Sort one synthetic session, returning timings and counts."""
+    random_state = random.Random(seed + 1)
+    session = make_session(number_of_elements, seed, compact)
+
+    start = time.perf_counter()
+    sm = SortingManager(session, **manager_options)
+    setup_time = time.perf_counter() - start
+
+    latencies = {'select': [], 'undo': [], 'redo': [], 'progress': []}
+    decisions = 0
+    perf_counter = time.perf_counter
+    while not sm.is_sorted():
+        if max_decisions is not None and decisions >= max_decisions:
+            break
+        selection = oracle(sm.options)
+
+        start = perf_counter()
+        sm.select(selection)
+        latencies['select'].append(perf_counter() - start)
+        decisions += 1
+
+        # Undo and redo straight away so the sort still moves forward
+        if random_state.random() < undo_rate:
+            start = perf_counter()
+            sm.undo()
+            latencies['undo'].append(perf_counter() - start)
+            start = perf_counter()
+            sm.redo()
+            latencies['redo'].append(perf_counter() - start)
+
+        start = perf_counter()
+        sm.progress
+        latencies['progress'].append(perf_counter() - start)
+
+    result = {'setup_s': setup_time,
+              'decisions': decisions,
+              'comparison_budget': sm.total_comparisons,
+              'finished': sm.is_sorted()}
+    if sm.is_sorted() and number_of_elements > 0:
+        final = list(sm.sorting_state[1])
+        result['correct'] = final == sorted(final)
+    if timed:
+        result['latency'] = {name: summarise(samples)
+                             for name, samples in latencies.items()}
+        result['total_s'] = setup_time + sum(sum(samples) for samples
+                                             in latencies.values())
+    return result
+
+
+def benchmark_sorting(sizes, seed=0, compact=True, manager_options=None,
+                      undo_rate=0.05, max_decisions=None, memory=True):
+    """Time SortingManager on sessions of each size in sizes.
+
+    Peak memory is measured with tracemalloc in a second run, as tracing
+    slows every allocation down and would distort the latencies.
+    """
+    if manager_options is None:
+        manager_options = {}
+    results = []
+    for number_of_elements in sizes:
+        result = {'n': number_of_elements, 'compact': compact,
+                  'options': manager_options}
+        result.update(run_sort(number_of_elements, seed, compact,
+                               manager_options, undo_rate, max_decisions,
+                               True))
+        if memory:
+            tracemalloc.start()
+            run_sort(number_of_elements, seed, compact, manager_options,
+                     undo_rate, max_decisions, False)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append(result)
+        print("sort n={} decisions={} select p50={:.1f}us p99={:.1f}us"
+              .format(number_of_elements, result['decisions'],
+                      result['latency']['select']['p50_us']
+                      if result['latency']['select'] else 0,
+                      result['latency']['select']['p99_us']
+                      if result['latency']['select'] else 0))
+    return results
+
+
+def synthetic_dimensions(number_of_images, seed):
+    # A mix of landscape, portrait and the odd panorama
+    random_state = random.Random(seed)
+    dimensions = []
+    for _ in range(number_of_images):
+        width = random_state.randint(200, 6000)
+        height = random_state.randint(200, 4000)
+        dimensions.append((width, height))
+    return dimensions
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    return time.perf_counter() - start, value
+
+
+def benchmark_layout(sizes, seed=0, canvas_size=(1920, 1080), padding=30):
+    """Time the layout engines, the row height search and tile placement."""
+    try:
+        from layout import layout_engines, determine_layout, find_row_height
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    results = []
+    for number_of_images in sizes:
+        dimensions = synthetic_dimensions(number_of_images, seed)
+        result = {'n': number_of_images}
+        for engine in layout_engines:
+            row_height_time, row_height = timed(find_row_height, dimensions,
+                                                padding, canvas_size, engine)
+            layout_time, layout = timed(determine_layout, dimensions, padding,
+                                        canvas_size[0], row_height, engine)
+            result[engine] = {'find_row_height_s': row_height_time,
+                              'determine_layout_s': layout_time,
+                              'row_height': int(row_height),
+                              'rows': len(layout)}
+            try:
+                from montage import tile_positions
+            except ImportError as e:
+                result[engine]['tile_positions'] = {'skipped': str(e)}
+            else:
+                tiles_time, _ = timed(lambda: list(tile_positions(
+                    layout, dimensions, padding)))
+                result[engine]['tile_positions_s'] = tiles_time
+        results.append(result)
+        print("layout n={} {}".format(number_of_images, ' '.join(
+            '{}={:.3f}s'.format(engine, result[engine]['find_row_height_s'] +
+                                result[engine]['determine_layout_s'])
+            for engine in layout_engines)))
+    return results
+
+
+def benchmark_optimiser(number_of_rows=20, images_per_row=7, width=500,
+                        seed=0):
+    """Time ImageRowSystem.solve on single rows and solve_rows on a batch."""
+    try:
+        import numpy as np
+        from optimiser import ImageRowSystem, solve_rows
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    random_state = np.random.RandomState(seed)
+    dims_list = [random_state.uniform(50, 500, (images_per_row, 2))
+                 for _ in range(number_of_rows)]
+    bounds = [(0, 1)] * images_per_row
+
+    samples = []
+    iterations = []
+    for dims in dims_list:
+        solve_time, solution = timed(
+            ImageRowSystem(dims, width, bounds, 0.5).solve)
+        samples.append(solve_time)
+        iterations.append(int(solution.nit))
+
+    batch_time, _ = timed(solve_rows, dims_list, width,
+                          [bounds] * number_of_rows)
+    print("optimiser {} rows: solve p50={:.0f}us batch={:.3f}s".format(
+        number_of_rows, summarise(samples)['p50_us'], batch_time))
+    return {'rows': number_of_rows,
+            'images_per_row': images_per_row,
+            'solve_latency': summarise(samples),
+            'mean_iterations': sum(iterations) / len(iterations),
+            'solve_rows_s': batch_time}
+
+
+def run(arguments):
+    manager_options = {'scheduler': arguments.scheduler}
+    if arguments.min_gallop is not None:
+        manager_options['min_gallop'] = arguments.min_gallop
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'parameters': vars(arguments)}
+    if 'sort' in arguments.suites:
+        report['sorting'] = benchmark_sorting(
+            arguments.sizes, arguments.seed, not arguments.plain,
+            manager_options, arguments.undo_rate, arguments.max_decisions,
+            not arguments.no_memory)
+    if 'layout' in arguments.suites:
+        report['layout'] = benchmark_layout(arguments.layout_sizes,
+                                            arguments.seed)
+    if 'optimiser' in arguments.suites:
+        report['optimiser'] = benchmark_optimiser(seed=arguments.seed)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark sorting, layout and the row optimiser")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help="session sizes to sort, up to 1000000")
+    parser.add_argument('--layout-sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--suites', nargs='+',
+                        default=['sort', 'layout', 'optimiser'],
+                        choices=['sort', 'layout', 'optimiser'])
+    parser.add_argument('--scheduler', default='fifo',
+                        choices=['fifo', 'smallest'])
+    parser.add_argument('--min-gallop', type=int, default=None)
+    parser.add_argument('--undo-rate', type=float, default=0.05,
+                        help="fraction of decisions undone and redone")
+    parser.add_argument('--max-decisions', type=int, default=None,
+                        help="stop each sort after this many decisions")
+    parser.add_argument('--plain', action='store_true',
+                        help="use a deque of deques instead of a "
+                             "CompactSession")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="skip the tracemalloc run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    benchmark_arguments = parser.parse_args()
+
+    benchmark_report = run(benchmark_arguments)
+    with open(benchmark_arguments.output, 'w') as report_file:
+        json.dump(benchmark_report, report_file, indent=2)
+    print("report written to", benchmark_arguments.output)
@@ -0,0 +1,222 @@
+from collections import deque
+from array import array
+
+
+class CompactSession:
+    """A sortable deque of runs that stores elements as ids packed in arrays.
+
+    Paths are interned once into a UTF-8 table and elements are referred to
+    by their index in it.  Tie groups made while sorting are given ids after
+    the paths.  Queued runs are stored back to back in the array "ids" with
+    the array "bounds" holding where each run starts, so a million singleton
+    runs cost a few megabytes instead of a million deques.  Only runs taken
+    from the front of the queue, the few a merge works on, are unpacked into
+    deques.  Runs appended to the end are packed straight away.
+
+    It supports the deque operations SortingManager uses on its
+    sortableDeque, with indexing limited to the front runs.
+
+    Example:
+
+    session = CompactSession(["images/a.jpg", "images/b.jpg"])
+    sm = SortingManager(session)
+
+    sm.options is ["images/a.jpg", "images/b.jpg"] and session[1] is
+    deque([0])
+    """
+
+    def __init__(self, elements=(), shared=None):
+        """Initialise CompactSession instance.
+
+        Args:
+            elements: paths, or tuples of paths for groups of ties, each
+                queued as a run of its own behind an empty output run
+            shared: CompactSession whose path and group tables are used
+                instead of elements
+        """
+        if shared is None:
+            self.offsets = array('Q', [0])
+            self.groups = []
+            self.group_ids = {}
+            blob = bytearray()
+            for element in elements:
+                for path in (element if isinstance(element, tuple)
+                             else (element,)):
+                    blob += path.encode('utf-8')
+                    self.offsets.append(len(blob))
+            self.blob = bytes(blob)
+        else:
+            self.offsets = shared.offsets
+            self.groups = shared.groups
+            self.group_ids = shared.group_ids
+            self.blob = shared.blob
+        self.number_of_paths = len(self.offsets) - 1
+
+        self.head = deque()
+        self.ids = array('I')
+        self.bounds = array('I', [0])
+        self.first = 0
+
+        if shared is None:
+            self.head.append(deque())
+            path_id = 0
+            for element in elements:
+                if isinstance(element, tuple):
+                    group = tuple(range(path_id, path_id + len(element)))
+                    path_id += len(element)
+                    self.pack(deque([group]))
+                else:
+                    self.pack(deque([path_id]))
+                    path_id += 1
+
+    def path(self, path_id):
+        return str(self.blob[self.offsets[path_id]:
+                             self.offsets[path_id + 1]], 'utf-8')
+
+    def resolve(self, element):
+        if isinstance(element, tuple):
+            return tuple(self.resolve(member) for member in element)
+        return self.path(element)
+
+    def resolved(self):
+        """Return the runs as a deque of deques of paths."""
+        return deque(deque(self.resolve(element) for element in run)
+                     for run in self)
+
+    def intern(self, element):
+        # Tie groups are tuples, they get an id after the paths the first
+        # time they are packed
+        if isinstance(element, tuple):
+            group_id = self.group_ids.get(element)
+            if group_id is None:
+                group_id = self.number_of_paths + len(self.groups)
+                self.groups.append(element)
+                self.group_ids[element] = group_id
+            return group_id
+        return element
+
+    def element(self, element_id):
+        if element_id < self.number_of_paths:
+            return element_id
+        return self.groups[element_id - self.number_of_paths]
+
+    def make_writable(self):
+        # Runs read from a session file are memoryviews of it until the
+        # queue first changes.  The path table is never changed.
+        if isinstance(self.ids, memoryview):
+            ids = array('I')
+            ids.frombytes(self.ids.cast('B'))
+            bounds = array('I')
+            bounds.frombytes(self.bounds.cast('B'))
+            self.ids = ids
+            self.bounds = bounds
+
+    def packed(self):
+        return len(self.bounds) - 1 - self.first
+
+    def pack(self, run):
+        self.make_writable()
+        self.ids.extend(self.intern(element) for element in run)
+        self.bounds.append(len(self.ids))
+
+    def unpack(self, start, end):
+        return deque(self.element(element_id)
+                     for element_id in self.ids[start:end])
+
+    def unpack_first(self):
+        run = self.unpack(self.bounds[self.first], self.bounds[self.first + 1])
+        self.first += 1
+        # Runs taken from the front are only skipped over until they make up
+        # half of the arrays.
+        if 2 * self.first >= len(self.bounds):
+            self.make_writable()
+            offset = self.bounds[self.first]
+            del self.ids[:offset]
+            self.bounds = array('I', (bound - offset for bound
+                                      in self.bounds[self.first:]))
+            self.first = 0
+        return run
+
+    def unpack_last(self):
+        self.make_writable()
+        end = self.bounds.pop()
+        start = self.bounds[-1]
+        run = self.unpack(start, end)
+        del self.ids[start:]
+        return run
+
+    def unpack_front(self, count):
+        while len(self.head) < count and self.packed() > 0:
+            self.head.append(self.unpack_first())
+
+    def run_lengths(self):
+        # Taken from the bounds so nothing is unpacked
+        lengths = [len(run) for run in self.head]
+        lengths.extend(self.bounds[index + 1] - self.bounds[index]
+                       for index in range(self.first, len(self.bounds) - 1))
+        return lengths
+
+    def __len__(self):
+        return len(self.head) + self.packed()
+
+    def __iter__(self):
+        for run in list(self.head):
+            yield run
+        for index in range(self.first, len(self.bounds) - 1):
+            yield self.unpack(self.bounds[index], self.bounds[index + 1])
+
+    def __getitem__(self, index):
+        self.unpack_front(index + 1)
+        return self.head[index]
+
+    def __delitem__(self, index):
+        self.unpack_front(index + 1)
+        del self.head[index]
+
+    def insert(self, index, run):
+        self.unpack_front(index)
+        self.head.insert(index, run)
+
+    def append(self, run):
+        self.pack(run)
+
+    def appendleft(self, run):
+        self.head.appendleft(run)
+
+    def pop(self):
+        if self.packed() > 0:
+            return self.unpack_last()
+        return self.head.pop()
+
+    def popleft(self):
+        if len(self.head) > 0:
+            return self.head.popleft()
+        if self.packed() > 0:
+            return self.unpack_first()
+        raise IndexError("pop from an empty CompactSession")
+
+    def split(self, kept):
+        """Remove every run after the first kept and return them sorted by
+        length, in a CompactSession sharing this one's tables."""
+        self.unpack_front(kept)
+        extra = []
+        while len(self.head) > kept:
+            extra.append(self.head.pop())
+        extra.reverse()
+
+        runs = CompactSession(shared=self)
+        lengths = [len(run) for run in extra]
+        lengths.extend(self.run_lengths()[len(self.head):])
+        for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+            if index < len(extra):
+                runs.pack(extra[index])
+            else:
+                index += self.first - len(extra)
+                runs.ids.extend(self.ids[self.bounds[index]:
+                                         self.bounds[index + 1]])
+                runs.bounds.append(len(runs.ids))
+
+        self.ids = array('I')
+        self.bounds = array('I', [0])
+        self.first = 0
+        return runs
@@ -0,0 +1,101 @@
+import json
+from collections import defaultdict, deque
+
+
+class ComparisonMemo:
+    """Remember pairwise decisions on disk and infer the ones they imply.
+
+    Every decision is stored as an edge from the element that was placed
+    first to the one placed after it.  A pair is known if either element can
+    be reached from the other, so answering a before b and b before c also
+    answers a before c.  The search is bounded by max_visits to keep lookups
+    quick on large memos.  Decisions are appended to filename as JSON lines
+    and flushed as they are made, so they survive restarts and reshuffled
+    sessions.  A later decision on the same pair overrides an earlier one.
+
+    Example:
+
+    memo = ComparisonMemo("comparisons.memo")
+    memo.record("a.jpg", "b.jpg")
+    memo.record("b.jpg", "c.jpg")
+
+    memo.known("a.jpg", "c.jpg") returns 0 and memo.known("c.jpg", "a.jpg")
+    returns 1, the selection that puts the first element before the second.
+    """
+
+    def __init__(self, filename=None, max_visits=10000):
+        """Initialise ComparisonMemo instance.
+
+        Args:
+            filename: JSON lines file the decisions are kept in, None to keep
+                them in memory only
+            max_visits: maximum number of elements visited per lookup
+        """
+        self.filename = filename
+        self.max_visits = max_visits
+        self.before = defaultdict(set)
+        self.memo_file = None
+
+        if filename is not None:
+            try:
+                with open(filename, 'r') as memo_file:
+                    for line in memo_file:
+                        if line.strip():
+                            first, second = json.loads(line)
+                            self.add(first, second)
+            except FileNotFoundError:
+                pass
+            self.memo_file = open(filename, 'a')
+
+    def add(self, first, second):
+        self.before[second].discard(first)
+        self.before[first].add(second)
+
+    def record(self, first, second):
+        if second in self.before.get(first, ()):
+            return
+        self.add(first, second)
+        if self.memo_file is not None:
+            self.memo_file.write(''.join([json.dumps([first, second]), '\n']))
+            self.memo_file.flush()
+
+    def record_selection(self, options, selection):
+        if selection in (0, 1):
+            self.record(options[selection], options[1 - selection])
+
+    def reaches(self, start, goal):
+        if start not in self.before:
+            return False
+        visited = {start}
+        queue = deque([start])
+        while queue:
+            for element in self.before.get(queue.popleft(), ()):
+                if element == goal:
+                    return True
+                if element not in visited:
+                    if len(visited) >= self.max_visits:
+                        return False
+                    visited.add(element)
+                    queue.append(element)
+        return False
+
+    def known(self, first, second):
+        """Return the selection implied for options [first, second], or None.
+        """
+        if self.reaches(first, second):
+            return 0
+        if self.reaches(second, first):
+            return 1
+        return None
+
+    def attach(self, sm):
+        # Only managers that answer questions from the memo are given it.
+        # Others would carry its open file into their snapshots, which can't
+        # be pickled.
+        if hasattr(sm, 'answer_known'):
+            sm.memo = self
+
+    def close(self):
+        if self.memo_file is not None:
+            self.memo_file.close()
+            self.memo_file = None
@@ -1,25 +1,143 @@
 from os import walk
-from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pickle
 from random import shuffle
+import numpy
+from PIL import Image
+from compactsession import CompactSession
 
-# Get a list of files to process from a directory
+# Near duplicates, such as burst shots and re-exports, are found with a 64
+# bit difference hash and put into the session as a single tie group, so
+# they cost one round of comparisons between them all.  Hashes at most
+# maximumDistance bits apart are counted as duplicates, None turns the
+# grouping off.
 directoryName = "images"
-recordList = []
-for (directoryPath, directoryNames, fileNames)\
-        in walk(directoryName):
-    recordList.extend(fileNames)
-    break
-numberOfRecords = len(recordList)
+maximumDistance = 4
 
-sortableDeque = deque()
-shuffle(recordList)
 
-for element in recordList:
-    singleElement = deque([''.join([directoryName, '/', element])])
-    sortableDeque.append(singleElement)
+def difference_hash(filename):
+    """Return the 64 bit dHash of an image, or None if it can't be read.
 
-emptyElement = deque()
-sortableDeque.appendleft(emptyElement)
+    The image is decoded at low resolution, shrunk to 9x8 greyscale and each
+    bit records whether a pixel is brighter than its right hand neighbour.
+    """
+    try:
+        with Image.open(filename) as im:
+            if im.format == 'JPEG':
+                im.draft('L', (64, 64))
+            pixels = list(im.convert('L').resize((9, 8),
+                                                 Image.BILINEAR).getdata())
+    except Exception:
+        # Pillow raises more than OSError for bad files, such as
+        # DecompressionBombError for images too large to decode safely
+        return None
 
-pickle.dump(sortableDeque, open("sortable1.srt", "wb"))
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            position = row * 9 + column
+            value = (value << 1) | (pixels[position] > pixels[position + 1])
+    return value
+
+
+def find_root(parents, element):
+    while parents[element] != element:
+        parents[element] = parents[parents[element]]
+        element = parents[element]
+    return element
+
+
+def union(parents, first, second):
+    first = find_root(parents, first)
+    second = find_root(parents, second)
+    if first != second:
+        parents[max(first, second)] = min(first, second)
+
+
+def candidate_pairs(hashes, maximum_distance):
+    """Yield index arrays of hash pairs that could be within the distance.
+
+    The 64 bits are split into maximum_distance + 1 chunks.  Two hashes
+    within the distance must match exactly in at least one chunk, so only
+    hashes sharing a chunk value are paired up.  Pairs are found by sorting
+    on each chunk and comparing hashes a fixed offset apart in that order.
+    """
+    boundaries = numpy.linspace(0, 64, maximum_distance + 2).astype(int)
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        mask = numpy.uint64((1 << int(end - start)) - 1)
+        keys = (hashes >> numpy.uint64(start)) & mask
+        order = numpy.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        offset = 1
+        while offset < len(order):
+            same = sorted_keys[offset:] == sorted_keys[:-offset]
+            if not same.any():
+                break
+            yield order[:-offset][same], order[offset:][same]
+            offset += 1
+
+
+def hamming_distances(first, second):
+    bit_counts = numpy.array([bin(byte).count('1') for byte in range(256)],
+                             dtype=numpy.uint8)
+    difference = (first ^ second).view(numpy.uint8).reshape(-1, 8)
+    return bit_counts[difference].sum(axis=1)
+
+
+def cluster_hashes(hashes, maximum_distance):
+    """Group indices of hashes that are within maximum_distance of another.
+
+    Grouping is transitive, so a chain of small differences can end up in
+    one group.
+    """
+    hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+    unique_hashes, inverse = numpy.unique(hashes, return_inverse=True)
+    parents = list(range(len(unique_hashes)))
+
+    for first, second in candidate_pairs(unique_hashes, maximum_distance):
+        close = hamming_distances(unique_hashes[first],
+                                  unique_hashes[second]) <= maximum_distance
+        for a, b in zip(first[close].tolist(), second[close].tolist()):
+            union(parents, a, b)
+
+    groups = {}
+    for index, unique_index in enumerate(inverse.tolist()):
+        groups.setdefault(find_root(parents, unique_index), []).append(index)
+    return list(groups.values())
+
+
+if __name__ == "__main__":
+    # Get a list of files to process from a directory
+    recordList = []
+    for (directoryPath, directoryNames, fileNames)\
+            in walk(directoryName):
+        recordList.extend(fileNames)
+        break
+    numberOfRecords = len(recordList)
+
+    pathList = [''.join([directoryName, '/', element])
+                for element in recordList]
+
+    elementList = pathList
+    if maximumDistance is not None:
+        with ProcessPoolExecutor() as executor:
+            hashList = list(executor.map(difference_hash, pathList,
+                                         chunksize=64))
+
+        hashed = [index for index, value in enumerate(hashList)
+                  if value is not None]
+        elementList = [pathList[index] for index, value
+                       in enumerate(hashList) if value is None]
+        for group in cluster_hashes([hashList[index] for index in hashed],
+                                    maximumDistance):
+            paths = sorted(pathList[hashed[index]] for index in group)
+            elementList.append(paths[0] if len(paths) == 1
+                               else tuple(paths))
+        print(numberOfRecords, "images,", len(elementList),
+              "after grouping near duplicates")
+
+    # Every element is queued as a run of its own behind an empty output run
+    shuffle(elementList)
+    sortableDeque = CompactSession(elementList)
+
+    pickle.dump(sortableDeque, open("sortable1.srt", "wb"))
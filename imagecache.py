@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from PIL import Image
+
+
+def open_reduced(filename, size):
+    """Decode an image at no more resolution than is needed to cover size.
+
+    JPEGs are decoded with draft mode, which scales the DCT by 1/2, 1/4 or
+    1/8 and never below size.  Other formats are decoded in full and then
+    reduced by the largest integer factor that still covers size.  The size
+    of the original is kept in info['source_size'] so callers can tell
+    whether a larger decode would gain any detail.
+
+    Args:
+        filename: path of the image
+        size: (width, height) the decoded image should cover
+    """
+    width = max(size[0], 1)
+    height = max(size[1], 1)
+    with Image.open(filename) as im:
+        source_size = im.size
+        if im.format == 'JPEG':
+            im.draft(im.mode, (width, height))
+        im.load()
+        image = im
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands()
+                                  else 'RGB')
+        factor = min(image.width // width, image.height // height)
+        if factor > 1:
+            image = image.reduce(factor)
+        elif image is im:
+            image = im.copy()
+    image.info['source_size'] = source_size
+    return image
+
+
+def fit_image(filename, size):
+    """Decode an image and shrink it to fit inside size.
+
+    Args:
+        filename: path of the image
+        size: (width, height) box the image has to fit in
+    """
+    image = open_reduced(filename, size)
+    source_size = image.info['source_size']
+    image.thumbnail(size, Image.LANCZOS)
+    image.info['source_size'] = source_size
+    return image
+
+
+class ImageCache:
+    """Hold decoded images in least recently used order, bounded by memory.
+
+    Images are keyed by (filename, size).  Once the estimated memory of the
+    cached images exceeds max_bytes the least recently used are dropped.
+    All methods are safe to call from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        """Initialise ImageCache instance.
+
+        Args:
+            max_bytes: memory the cached images may use
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def largest(self, filename):
+        # The largest decode of filename at any size, or None
+        with self.lock:
+            images = [image for (name, _), image in self.images.items()
+                      if name == filename]
+        if not images:
+            return None
+        return max(images, key=lambda image: image.width * image.height)
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.images:
+                self.bytes -= self.image_bytes(self.images.pop(key))
+            self.images[key] = image
+            self.bytes += self.image_bytes(image)
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, oldest = self.images.popitem(last=False)
+                self.bytes -= self.image_bytes(oldest)
+
+
+class Prefetcher:
+    """Decode images on a thread pool ahead of them being displayed.
+
+    prefetch() queues images that may be needed soon, load() returns an
+    image straight from the cache, waits for a decode already under way or
+    decodes it on the calling thread as a last resort.
+
+    Example:
+
+    prefetcher = Prefetcher(ImageCache(256 * 2**20))
+    prefetcher.prefetch(["images/a.jpg", "images/b.jpg"], (512, 512))
+    image = prefetcher.load("images/a.jpg", (512, 512))
+    """
+
+    def __init__(self, cache, workers=2, decoder=fit_image):
+        """Initialise Prefetcher instance.
+
+        Args:
+            cache: ImageCache decoded images are stored in
+            workers: number of decoding threads
+            decoder: callable(filename, size) returning the image to cache
+        """
+        self.cache = cache
+        self.decoder = decoder
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def decode(self, key):
+        try:
+            image = self.decoder(*key)
+            self.cache.put(key, image)
+            return image
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def prefetch(self, filenames, size):
+        for filename in filenames:
+            key = (filename, size)
+            if key in self.cache:
+                continue
+            with self.lock:
+                if key not in self.pending:
+                    self.pending[key] = self.executor.submit(self.decode, key)
+
+    def load(self, filename, size):
+        key = (filename, size)
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+
+        with self.lock:
+            future = self.pending.get(key)
+        if future is not None:
+            return future.result()
+        return self.decode(key)
+
+    def preview(self, filename):
+        # Whatever has already been decoded, without waiting
+        return self.cache.largest(filename)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,29 @@
+from os import walk
+import pickle
+from random import shuffle
+from insertionmanager import InsertionManager
+
+# Add images that are not yet in a finished sort to it by binary insertion.
+# The finished order is read from results.txt as written by the montage.
+# Tied images share a line and are inserted against in the order listed.
+directoryName = "images"
+with open("results.txt") as result_file:
+    sortedList = [image_file for line in result_file if line.strip()
+                  for image_file in line.rstrip('\n').split('\t')]
+sortedSet = set(sortedList)
+
+recordList = []
+for (directoryPath, directoryNames, fileNames)\
+        in walk(directoryName):
+    recordList.extend(fileNames)
+    break
+
+newList = [''.join([directoryName, '/', element]) for element in recordList]
+newList = [element for element in newList if element not in sortedSet]
+shuffle(newList)
+
+insertionManager = InsertionManager(sortedList, newList)
+print(len(newList), "new images, at most",
+      insertionManager.progress[1], "comparisons")
+
+pickle.dump(insertionManager, open("sortable1.srt", "wb"))
@@ -0,0 +1,132 @@
+from collections import deque
+from array import array
+from sortingmanager import SortingManager
+
+
+class InsertionManager:
+    """Insert new elements into an already sorted list by binary search.
+
+    Each new element costs about log2(n) comparisons, instead of sorting
+    everything again.  The interface matches SortingManager: options holds
+    the element being bisected against and the element being inserted,
+    select(0) means the sorted element comes first and select(1) means the
+    new one does.
+
+    Example:
+
+    im = InsertionManager(["a.jpg", "c.jpg"], ["b.jpg"])
+    im.options is ["c.jpg", "b.jpg"]; after im.select(1) and then
+    im.select(0) the sorting state holds a.jpg, b.jpg, c.jpg
+    """
+
+    def __init__(self, sorted_elements, new_elements):
+        """Initialise InsertionManager instance.
+
+        Args:
+            sorted_elements: sequence in sorted order
+            new_elements: sequence of elements to insert
+        """
+        self.sortedList = list(sorted_elements)
+        self.pending = deque(new_elements)
+        self.lower = 0
+        self.upper = len(self.sortedList)
+
+        # Each undoable decision is stored as four integers: the selection,
+        # the bounds before it and where an element was inserted or -1.
+        self.undoableActions = array('i')
+        self.redoableActions = array('b')
+
+        self.determine_state()
+        self.total_comparisons = self.remaining_comparisons()
+
+    def determine_state(self):
+        # An empty interval means the position is known
+        if self.pending and self.lower == self.upper:
+            position = self.lower
+            self.sortedList.insert(position, self.pending.popleft())
+            self.lower = 0
+            self.upper = len(self.sortedList)
+            return position
+        return -1
+
+    def apply_selection(self, selection):
+        lower = self.lower
+        upper = self.upper
+        middle = (self.lower + self.upper) // 2
+        if selection == 0:
+            self.lower = middle + 1
+        else:
+            self.upper = middle
+        position = self.determine_state()
+        self.undoableActions.extend((selection, lower, upper, position))
+
+    def undo_selection(self):
+        selection, lower, upper, position = self.undoableActions[-4:]
+        del self.undoableActions[-4:]
+        if position >= 0:
+            self.pending.appendleft(self.sortedList.pop(position))
+        self.lower = lower
+        self.upper = upper
+        return selection
+
+    def select(self, selection):
+        if not self.is_sorted() and selection in (0, 1):
+            del self.redoableActions[:]
+            self.apply_selection(selection)
+
+    def undo(self):
+        if len(self.undoableActions) >= 4:
+            self.redoableActions.append(self.undo_selection())
+
+    def redo(self):
+        if len(self.redoableActions) >= 1:
+            self.apply_selection(self.redoableActions.pop())
+
+    def is_sorted(self):
+        return len(self.pending) == 0
+
+    def next_options(self, selection):
+        if self.is_sorted():
+            return None
+        self.apply_selection(selection)
+        next_options = self.options
+        self.undo_selection()
+        return next_options
+
+    def upcoming_options(self):
+        return SortingManager.upcoming(self.next_options)
+
+    @property
+    def options(self):
+        if self.is_sorted():
+            return None
+        middle = (self.lower + self.upper) // 2
+        return [self.sortedList[middle], self.pending[0]]
+
+    @property
+    def sorted(self):
+        return self.is_sorted()
+
+    @property
+    def sorting_state(self):
+        # Laid out like a SortingManager session, pending elements are
+        # single element runs
+        state = deque([deque(), deque(self.sortedList)])
+        state.extend(deque([element]) for element in self.pending)
+        return state
+
+    def remaining_comparisons(self):
+        # A list of n elements has n + 1 places to insert into, which takes
+        # n.bit_length() comparisons to narrow down.
+        if self.is_sorted():
+            return 0
+        remaining = (self.upper - self.lower).bit_length()
+        length = len(self.sortedList)
+        for inserted in range(1, len(self.pending)):
+            remaining += (length + inserted).bit_length()
+        return remaining
+
+    @property
+    def progress(self):
+        remaining = min(self.remaining_comparisons(), self.total_comparisons)
+        return [remaining, self.total_comparisons]
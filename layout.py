@@ -0,0 +1,265 @@
+import numpy as np
+
+
+def aspect_ratios(dimensions):
+    dimensions = np.asarray(dimensions, dtype=float).reshape(-1, 2)
+    return dimensions[:, 0] / dimensions[:, 1]
+
+
+def layout_rows(aspects, padding, width, maximum_height, maximum_rows=None):
+    """Break images into rows the same way as the original greedy layout.
+
+    A row is closed as soon as its height drops below maximum_height, where
+    a row of k images with aspect ratio sum S is (width - padding*(k+1))/S
+    high.  That condition is H*S + padding*k > width - padding, and the
+    left hand side is a difference of the strictly increasing prefix sums
+    H*C[i] + padding*(i+1), so each row break is a binary search.
+
+    Args:
+        aspects: array of width/height ratios
+        padding: space between and around images
+        width: width of the canvas
+        maximum_height: height a row has to drop below to be closed
+        maximum_rows: stop after this many rows, None lays out every image
+
+    Returns:
+        list of [first image, last image, row height]
+    """
+    return_value = []
+    number_of_images = len(aspects)
+    cumulative_aspects = np.cumsum(aspects)
+    prefix = maximum_height * cumulative_aspects + \
+        padding * np.arange(1, number_of_images + 1)
+
+    start = 0
+    while start < number_of_images:
+        if maximum_rows is not None and len(return_value) >= maximum_rows:
+            break
+        if start == 0:
+            base_prefix = 0.0
+            base_aspect = 0.0
+        else:
+            base_prefix = prefix[start - 1]
+            base_aspect = cumulative_aspects[start - 1]
+
+        end = int(np.searchsorted(prefix, base_prefix + width - padding,
+                                  side='right'))
+        if end >= number_of_images:
+            return_value.append([start, number_of_images - 1,
+                                 maximum_height])
+            break
+
+        number_of_images_in_row = end - start + 1
+        aspect_ratio_sum = cumulative_aspects[end] - base_aspect
+        height = (width - padding * (number_of_images_in_row + 1)) / \
+            aspect_ratio_sum
+        return_value.append([start, end, float(height)])
+        start = end + 1
+    return return_value
+
+
+def optimal_layout_rows(aspects, padding, width, target_height):
+    """Choose row breaks that keep rows as close to target_height as possible.
+
+    A row of images i to j-1 drawn target_height high needs
+    target_height*S + padding*(k+1) pixels, and the cost of the row is the
+    square of the slack against the canvas width.  With prefix sums
+    B[t] = target_height*A[t] + padding*t the slack is
+    (width - padding) - (B[j] - B[i]).  The cost is a convex function of a
+    difference of increasing prefix sums, which satisfies the quadrangle
+    inequality.  Optimal break points therefore move monotonically, and the
+    dynamic program is solved in O(n log n) with a queue of candidate
+    breaks, each found by a galloping search.  The last row is free when it is
+    short, it is drawn target_height high rather than stretched.
+
+    Args:
+        aspects: array of width/height ratios
+        padding: space between and around images
+        width: width of the canvas
+        target_height: row height to aim for
+
+    Returns:
+        list of [first image, last image, row height]
+    """
+    aspects = np.asarray(aspects, dtype=float)
+    number_of_images = len(aspects)
+    if number_of_images == 0:
+        return []
+
+    # The prefix sums are worked out by NumPy but read back as a list, as
+    # the loop below indexes them one at a time and list indexing is much
+    # faster than indexing an array.
+    prefix_array = np.concatenate([[0.0], np.cumsum(target_height * aspects +
+                                                    padding)])
+    prefix = prefix_array.tolist()
+    capacity = width - padding
+
+    cost = [0.0] * (number_of_images + 1)
+    previous_break = [0] * (number_of_images + 1)
+
+    def value(i, j):
+        slack = capacity - (prefix[j] - prefix[i])
+        return cost[i] + slack * slack
+
+    # Each entry is (candidate break, first row end it is best for)
+    candidates = [(0, 1)]
+    first = 0
+    for j in range(1, number_of_images + 1):
+        while (first + 1 < len(candidates) and
+               candidates[first + 1][1] <= j):
+            first += 1
+        best = candidates[first][0]
+        cost[j] = value(best, j)
+        previous_break[j] = best
+
+        if j == number_of_images:
+            break
+
+        # Drop candidates that j beats from where they take over onwards
+        while len(candidates) > first:
+            candidate, start = candidates[-1]
+            position = max(start, j + 1)
+            if value(j, position) <= value(candidate, position):
+                candidates.pop()
+            else:
+                break
+
+        if len(candidates) == first:
+            candidates.append((j, j + 1))
+            continue
+
+        # Search for where j starts beating the last candidate.  That is
+        # usually within a row or two of j, so it is bracketed by galloping
+        # out from the earliest possible position before bisecting.
+        candidate, start = candidates[-1]
+        lower = max(start, j + 1) + 1
+        upper = lower
+        step = 1
+        while (upper <= number_of_images and
+               value(j, upper) > value(candidate, upper)):
+            lower = upper + 1
+            upper += step
+            step *= 2
+        upper = min(upper, number_of_images + 1)
+        while lower < upper:
+            middle = (lower + upper) // 2
+            if value(j, middle) <= value(candidate, middle):
+                upper = middle
+            else:
+                lower = middle + 1
+        if lower <= number_of_images:
+            candidates.append((j, lower))
+
+    # The last row only costs anything if it is too wide at target_height
+    slack = capacity - (prefix_array[-1] - prefix_array[:-1])
+    last_start = int(np.argmin(np.array(cost[:-1]) +
+                               np.where(slack < 0, slack * slack, 0.0)))
+
+    breaks = [number_of_images]
+    position = last_start
+    while position > 0:
+        breaks.append(position)
+        position = previous_break[position]
+    breaks.append(0)
+    breaks.reverse()
+
+    cumulative_aspects = [0.0] + np.cumsum(aspects).tolist()
+    return_value = []
+    for start, end in zip(breaks[:-1], breaks[1:]):
+        number_of_images_in_row = end - start
+        aspect_ratio_sum = cumulative_aspects[end] - cumulative_aspects[start]
+        height = (width - padding * (number_of_images_in_row + 1)) / \
+            aspect_ratio_sum
+        if end == number_of_images:
+            height = min(height, target_height)
+        return_value.append([start, end - 1, height])
+    return return_value
+
+
+layout_engines = {'greedy': layout_rows,
+                  'optimal': optimal_layout_rows}
+
+
+def determine_layout(dimensions, padding, width, maximum_height,
+                     engine='greedy'):
+    return layout_engines[engine](aspect_ratios(dimensions), padding, width,
+                                  maximum_height)
+
+
+def layout_height(layout, padding):
+    total_height = padding
+    for row in layout:
+        total_height += padding + max(int(row[2]), 1)
+    return total_height
+
+
+def find_row_height(dimensions, padding, canvas_size, engine='greedy'):
+    """Find the largest whole row height whose layout fits on the canvas.
+
+    The layout gets taller as the row height grows, so bisecting finds the
+    same row height as raising it a pixel at a time until the layout is too
+    tall and stepping back one.
+    The search is bounded by the canvas height, as no taller row fits, and
+    by the tallest single image row, past which every image gets its own
+    row and the layout stops changing.  Every row adds at least padding + 1
+    to the height, so greedy layouts are only worked out until they have
+    more rows than the canvas can hold.  Other engines start from the
+    greedy row height.
+
+    Args:
+        dimensions: sequence of (width, height) pairs
+        padding: space between and around images
+        canvas_size: (width, height) of the canvas
+        engine: name of the layout engine in layout_engines
+    """
+    layout_rows_for = layout_engines[engine]
+    aspects = aspect_ratios(dimensions)
+    width, canvas_height = canvas_size
+    if len(aspects) == 0:
+        return 0
+
+    maximum_rows = canvas_height // (padding + 1) + 1
+
+    def too_tall(row_height):
+        if layout_rows_for is layout_rows:
+            layout = layout_rows(aspects, padding, width, row_height,
+                                 maximum_rows)
+        else:
+            layout = layout_rows_for(aspects, padding, width, row_height)
+        return layout_height(layout, padding) >= canvas_height
+
+    lower = 1
+    upper = min(int((width - 2 * padding) / np.min(aspects)) + 2,
+                canvas_height)
+    if not too_tall(upper):
+        return upper
+
+    if layout_rows_for is not layout_rows and lower < upper:
+        # Other engines lay out every image at each probe.  Their row height
+        # is usually within a few pixels of the greedy one, which is cheap
+        # to find, so the search gallops out from there to bracket the
+        # answer before bisecting.
+        guess = min(max(find_row_height(dimensions, padding, canvas_size),
+                        lower), upper - 1)
+        step = 1
+        if too_tall(guess):
+            upper = guess
+            while upper - step >= lower and too_tall(upper - step):
+                upper -= step
+                step *= 2
+            lower = max(lower, upper - step + 1)
+        else:
+            lower = guess + 1
+            while lower + step - 1 < upper and not too_tall(lower + step - 1):
+                lower += step
+                step *= 2
+            upper = min(upper, lower + step - 1)
+
+    # Bisect for the first row height that is too tall
+    while lower < upper:
+        middle = (lower + upper) // 2
+        if too_tall(middle):
+            upper = middle
+        else:
+            lower = middle + 1
+    return lower - 1
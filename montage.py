@@ -0,0 +1,160 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
+from PIL import Image
+from imagecache import fit_image
+from pngstream import PNGStreamWriter
+from thumbnailstore import ThumbnailStore
+
+# Thumbnail store opened once in each worker process
+worker_store = None
+
+
+def read_size(filename):
+    # Opening an image only parses its header, nothing is decoded
+    with Image.open(filename) as im:
+        return im.size
+
+
+def read_sizes(filenames, workers=8):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_size, filenames))
+
+
+def open_worker_store(thumbnail_directory):
+    global worker_store
+    if thumbnail_directory is not None:
+        worker_store = ThumbnailStore(thumbnail_directory)
+
+
+def render_tile(filename, size):
+    if worker_store is not None:
+        image = worker_store.load(filename, size)
+    else:
+        image = fit_image(filename, size)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+    return image.convert('RGB')
+
+
+def row_tiles(layout, dimensions, padding):
+    """Yield the vertical position, height and tiles of every layout row.
+
+    Each tile is an (image index, horizontal position, size) tuple.
+
+    Args:
+        layout: rows as returned by determine_layout
+        dimensions: sequence of (width, height) pairs
+        padding: space between and around images
+    """
+    vertical_position = padding
+    for row in layout:
+        horizontal_position = padding
+        height = max(int(row[2]), 1)
+        tiles = []
+
+        for image_index in range(row[0], row[1] + 1):
+            width = int(height * dimensions[image_index][0] /
+                        dimensions[image_index][1])
+            width = max(width, 1)
+            tiles.append((image_index, horizontal_position, (width, height)))
+            horizontal_position += width + padding
+
+        yield vertical_position, height, tiles
+        vertical_position += height + padding
+
+
+def tile_positions(layout, dimensions, padding):
+    """Yield (image index, position, size) for every image in a layout."""
+    for vertical_position, height, tiles in row_tiles(layout, dimensions,
+                                                      padding):
+        for image_index, horizontal_position, size in tiles:
+            yield (image_index, (horizontal_position, vertical_position),
+                   size)
+
+
+def render_montage(canvas, filenames, dimensions, layout, padding,
+                   thumbnail_directory=None, workers=None):
+    """Decode and resize the tiles of a montage in parallel onto canvas.
+
+    Tiles are decoded at reduced resolution in a process pool, optionally
+    through a ThumbnailStore, and pasted as each worker finishes.
+
+    Args:
+        canvas: image the tiles are pasted onto
+        filenames: images in layout order
+        dimensions: sequence of (width, height) pairs
+        layout: rows as returned by determine_layout
+        padding: space between and around images
+        thumbnail_directory: ThumbnailStore directory, None to decode only
+        workers: number of processes, None for one per core
+    """
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=open_worker_store,
+                             initargs=(thumbnail_directory,)) as executor:
+        futures = {}
+        for image_index, position, size in tile_positions(layout, dimensions,
+                                                          padding):
+            future = executor.submit(render_tile, filenames[image_index],
+                                     size)
+            futures[future] = position
+
+        for future in as_completed(futures):
+            canvas.paste(future.result(), futures.pop(future))
+
+
+def stream_montage(filename, filenames, dimensions, layout, padding,
+                   canvas_size, thumbnail_directory=None, workers=None):
+    """Render a montage straight to a PNG one layout row at a time.
+
+    Only the current row strip and the tiles of the next row are held in
+    memory, so the canvas can be far larger than RAM.  The next row's tiles
+    are decoded while the current one is assembled.
+
+    Args:
+        filename: path of the PNG to write
+        filenames: images in layout order
+        dimensions: sequence of (width, height) pairs
+        layout: rows as returned by determine_layout
+        padding: space between and around images
+        canvas_size: (width, height) of the output
+        thumbnail_directory: ThumbnailStore directory, None to decode only
+        workers: number of processes, None for one per core
+    """
+    canvas_width, canvas_height = canvas_size
+
+    def submit_row(row):
+        vertical_position, height, tiles = row
+        futures = [(executor.submit(render_tile, filenames[image_index],
+                                    size), horizontal_position)
+                   for image_index, horizontal_position, size in tiles]
+        return height, futures
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=open_worker_store,
+                             initargs=(thumbnail_directory,)) as executor, \
+            PNGStreamWriter(filename, canvas_width, canvas_height) as writer:
+        writer.write_strip(Image.new("RGB", (canvas_width, padding), "white"))
+
+        rows = row_tiles(layout, dimensions, padding)
+        pending = None
+        for row in rows:
+            submitted = submit_row(row)
+            if pending is not None:
+                write_row(writer, canvas_width, padding, *pending)
+            pending = submitted
+        if pending is not None:
+            write_row(writer, canvas_width, padding, *pending)
+
+        # Fill whatever the layout leaves empty at the bottom
+        while writer.rows_written < canvas_height:
+            rows_left = min(canvas_height - writer.rows_written, 1024)
+            writer.write_strip(Image.new("RGB", (canvas_width, rows_left),
+                                         "white"))
+
+
+def write_row(writer, canvas_width, padding, height, futures):
+    # A row strip holds the images followed by the padding below them
+    strip = Image.new("RGB", (canvas_width, height + padding), "white")
+    for future, horizontal_position in futures:
+        strip.paste(future.result(), (horizontal_position, 0))
+    writer.write_strip(strip)
@@ -0,0 +1,390 @@
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+import pickle
+import time
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from compactsession import CompactSession
+from sortingmanager import SortingManager
+from sessionjournal import SessionJournal
+import sessionfile
+
+
+class MergeTask:
+    """One merge of two runs, with a single pending comparison."""
+
+    def __init__(self, task_id, left, right, output=()):
+        self.task_id = task_id
+        self.left = deque(left)
+        self.right = deque(right)
+        self.output = deque(output)
+        self.step = 0
+
+    @property
+    def comparison_id(self):
+        return ''.join([str(self.task_id), ':', str(self.step)])
+
+    @property
+    def options(self):
+        return [self.left[0], self.right[0]]
+
+    def select(self, selection):
+        if selection == 0:
+            self.output.append(self.left.popleft())
+        else:
+            self.output.append(self.right.popleft())
+        self.step += 1
+
+    def finished(self):
+        return len(self.left) == 0 or len(self.right) == 0
+
+    def result(self):
+        self.output.extend(self.left)
+        self.output.extend(self.right)
+        return self.output
+
+
+class ParallelSortingSession:
+    """Merge sort where every independent merge can be worked on at once.
+
+    Runs are merged in pairs as soon as two are ready, so during the
+    bottom-up passes hundreds of merges are open at the same time and each
+    exposes one comparison.  Comparisons have ids of the form
+    "merge:step" and can be answered in any order.  An answer for a step
+    that has already been answered is rejected as stale.  Handing out a
+    comparison with lease() keeps it from other raters for a while.
+
+    Example:
+
+    session = ParallelSortingSession([deque([4]), deque([1]), deque([3])])
+    for comparison in session.pending():
+        session.answer(comparison['id'], 0)
+    """
+
+    def __init__(self, runs, lease_seconds=120, merging=None):
+        """Initialise ParallelSortingSession instance.
+
+        Args:
+            runs: iterable of sorted runs, such as single element deques
+            lease_seconds: how long a leased comparison is held for a rater
+            merging: optional (output, left, right) runs of a merge that is
+                already under way
+        """
+        self.ready = deque(deque(run) for run in runs if len(run) != 0)
+        self.merges = {}
+        self.leases = {}
+        self.next_task_id = 0
+        self.lease_seconds = lease_seconds
+        self.answered = 0
+        if merging is not None:
+            output, left, right = merging
+            self.merges[0] = MergeTask(0, left, right, output)
+            self.next_task_id = 1
+        self.number_of_elements = (
+            sum(len(run) for run in self.ready) +
+            sum(len(task.output) + len(task.left) + len(task.right)
+                for task in self.merges.values()))
+        self.start_merges()
+        self.total_comparisons = self.progress[1]
+
+    @classmethod
+    def from_manager(cls, manager, lease_seconds=120):
+        """Carry on the sort of a session manager, such as a SortingManager.
+
+        The merge a SortingManager is part way through carries on where it
+        is, so no decision is lost.
+        """
+        runs = deque(manager.sorting_state)
+        initial_runs = getattr(manager, 'initialRuns', ())
+        if isinstance(initial_runs, CompactSession):
+            initial_runs = initial_runs.resolved()
+        runs.extend(initial_runs)
+
+        # The first run is the output of the merge of the next two
+        output = runs.popleft()
+        if len(output) == 0:
+            return cls(runs, lease_seconds)
+        left = runs.popleft()
+        right = runs.popleft()
+        return cls(runs, lease_seconds, (output, left, right))
+
+    @staticmethod
+    def comparisons_remaining(run_lengths):
+        # Worst case of merging the runs in pairs in queue order
+        lengths = deque(run_lengths)
+        comparison_count = 0
+        while len(lengths) > 1:
+            merged = lengths.popleft() + lengths.popleft()
+            comparison_count += merged - 1
+            lengths.append(merged)
+        return comparison_count
+
+    def start_merges(self):
+        while len(self.ready) >= 2:
+            task = MergeTask(self.next_task_id, self.ready.popleft(),
+                             self.ready.popleft())
+            self.next_task_id += 1
+            self.merges[task.task_id] = task
+
+    def comparison(self, task):
+        # A tie group from gatherimages.py is shown by its first element
+        return {'id': task.comparison_id,
+                'options': [SortingManager.representative(option)
+                            for option in task.options]}
+
+    def pending(self, limit=None):
+        comparisons = []
+        for task in self.merges.values():
+            if limit is not None and len(comparisons) >= limit:
+                break
+            comparisons.append(self.comparison(task))
+        return comparisons
+
+    def lease(self):
+        """Return a comparison nobody else holds and hold it, or None."""
+        now = time.monotonic()
+        for task_id, task in self.merges.items():
+            expiry = self.leases.get(task.comparison_id)
+            if expiry is None or expiry < now:
+                self.leases[task.comparison_id] = now + self.lease_seconds
+                return self.comparison(task)
+        return None
+
+    def answer(self, comparison_id, selection):
+        """Apply an answer, returning False if it is stale or unknown."""
+        try:
+            task_id, step = (int(part) for part in comparison_id.split(':'))
+        except ValueError:
+            return False
+        task = self.merges.get(task_id)
+        if task is None or task.step != step or selection not in (0, 1):
+            return False
+
+        self.leases.pop(comparison_id, None)
+        task.select(selection)
+        self.answered += 1
+        if task.finished():
+            del self.merges[task_id]
+            self.ready.append(task.result())
+            self.start_merges()
+        return True
+
+    def is_sorted(self):
+        return len(self.merges) == 0
+
+    @property
+    def sorted(self):
+        return self.is_sorted()
+
+    @property
+    def sorting_state(self):
+        # Laid out like a finished SortingManager session
+        state = deque([deque()])
+        state.extend(self.ready)
+        return state
+
+    @property
+    def progress(self):
+        # The worst case of the open merges, then of merging their results
+        # in queue order.  Merges finishing in another order pair runs up
+        # differently, so the total is the answers given plus the work
+        # still to do rather than a budget fixed at the start.
+        remaining = sum(len(task.left) + len(task.right) - 1
+                        for task in self.merges.values())
+        lengths = [len(run) for run in self.ready]
+        lengths.extend(len(task.output) + len(task.left) + len(task.right)
+                       for task in self.merges.values())
+        remaining += self.comparisons_remaining(lengths)
+        return [remaining, self.answered + remaining]
+
+
+class SessionServer:
+    """Serve a ParallelSortingSession over HTTP/JSON with asyncio.
+
+    Every request is handled on the event loop thread, so the session needs
+    no locking.
+
+    GET /next                 lease a comparison, 204 when none are free
+    GET /comparisons?limit=n  list pending comparisons without leasing
+    POST /answer              {"id": ..., "selection": 0 or 1}
+    GET /progress             remaining and total comparisons
+    GET /result               the sorted elements once finished
+    GET /image?path=...       an image that is part of the session
+    """
+
+    def __init__(self, session, filename=None, save_every=100):
+        """Initialise SessionServer instance.
+
+        Args:
+            session: ParallelSortingSession to serve
+            filename: where the session is pickled, None to not save it
+            save_every: number of answers between saves
+        """
+        self.session = session
+        self.filename = filename
+        self.save_every = save_every
+        # Paths of every image in the session, including each member of a
+        # tie group
+        self.elements = set()
+        runs = list(session.sorting_state)
+        for task in session.merges.values():
+            runs.extend([task.left, task.right, task.output])
+        for run in runs:
+            for element in run:
+                self.elements.update(SortingManager.members(element))
+
+    def save(self):
+        if self.filename is None:
+            return
+        temporary_filename = ''.join([self.filename, '.tmp'])
+        with open(temporary_filename, 'wb') as session_file:
+            pickle.dump(self.session, session_file)
+        os.replace(temporary_filename, self.filename)
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = b''
+            if 'content-length' in headers:
+                body = await reader.readexactly(int(headers['content-length']))
+            status, content_type, payload = await self.route(method, target,
+                                                             body)
+        except (ValueError, KeyError, TypeError, IndexError,
+                asyncio.IncompleteReadError):
+            status, content_type, payload = self.json(400, {'error':
+                                                            'bad request'})
+        except Exception:
+            # Whatever went wrong, the client still gets an answer
+            status, content_type, payload = self.json(500, {'error':
+                                                            'server error'})
+
+        # A 204 response has no body, so no body headers either
+        lines = ['HTTP/1.1 ', status, '\r\n']
+        if content_type is not None:
+            lines.extend(['Content-Type: ', content_type, '\r\n',
+                          'Content-Length: ', str(len(payload)), '\r\n'])
+        lines.append('Connection: close\r\n\r\n')
+        writer.write(''.join(lines).encode('latin-1'))
+        writer.write(payload)
+        await writer.drain()
+        writer.close()
+
+    @staticmethod
+    def json(status, value):
+        reasons = {200: '200 OK', 400: '400 Bad Request',
+                   404: '404 Not Found', 409: '409 Conflict',
+                   500: '500 Internal Server Error'}
+        return (reasons[status], 'application/json',
+                json.dumps(value).encode('utf-8'))
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if method == 'GET' and url.path == '/next':
+            comparison = self.session.lease()
+            if comparison is None:
+                return '204 No Content', None, b''
+            return self.json(200, comparison)
+        if method == 'GET' and url.path == '/comparisons':
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            return self.json(200, self.session.pending(limit))
+        if method == 'POST' and url.path == '/answer':
+            answer = json.loads(body.decode('utf-8'))
+            if not isinstance(answer, dict):
+                return self.json(400, {'error': 'expected an object'})
+            accepted = self.session.answer(str(answer['id']),
+                                           answer['selection'])
+            if accepted and self.session.answered % self.save_every == 0:
+                self.save()
+            if accepted and self.session.is_sorted():
+                self.save()
+            return self.json(200 if accepted else 409,
+                             {'accepted': accepted})
+        if method == 'GET' and url.path == '/progress':
+            remaining, total = self.session.progress
+            return self.json(200, {'remaining': remaining, 'total': total,
+                                   'sorted': self.session.is_sorted()})
+        if method == 'GET' and url.path == '/result':
+            if not self.session.is_sorted():
+                return self.json(409, {'error': 'not sorted yet'})
+            return self.json(200, [member for element
+                                   in self.session.sorting_state[1]
+                                   for member
+                                   in SortingManager.members(element)])
+        if method == 'GET' and url.path == '/image':
+            path = query['path'][0]
+            # Only files that are part of the session are served
+            if path not in self.elements:
+                return self.json(404, {'error': 'unknown image'})
+            loop = asyncio.get_running_loop()
+            try:
+                with open(path, 'rb') as image_file:
+                    data = await loop.run_in_executor(None, image_file.read)
+            except OSError:
+                return self.json(404, {'error': 'image can not be read'})
+            content_type = mimetypes.guess_type(path)[0]
+            return ('200 OK', content_type or 'application/octet-stream',
+                    data)
+        return self.json(404, {'error': 'not found'})
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def load_session(filename):
+    """Return a ParallelSortingSession for a saved session.
+
+    That can be a ParallelSortingSession saved by the server, a bare
+    sortable deque or CompactSession from gatherimages.py, a pickled session
+    manager, or a session kept by SessionJournal, whose journal is replayed
+    first.
+    """
+    if sessionfile.is_session_file(filename):
+        loaded = None
+    else:
+        with open(filename, 'rb') as session_file:
+            loaded = pickle.load(session_file)
+    if loaded is None or isinstance(loaded, tuple):
+        journal = SessionJournal(filename)
+        loaded = journal.open()
+        journal.close()
+
+    if isinstance(loaded, ParallelSortingSession):
+        return loaded
+    if isinstance(loaded, CompactSession):
+        loaded = loaded.resolved()
+    if isinstance(loaded, deque):
+        return ParallelSortingSession(loaded)
+    return ParallelSortingSession.from_manager(loaded)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a sorting session to several raters at once")
+    parser.add_argument('session', help="sortable deque or saved session")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--output', default='parallel.srt',
+                        help="where the session is saved")
+    arguments = parser.parse_args()
+
+    session_server = SessionServer(load_session(arguments.session),
+                                   arguments.output)
+    try:
+        asyncio.run(session_server.serve(arguments.host, arguments.port))
+    finally:
+        session_server.save()
@@ -0,0 +1,78 @@
+import struct
+import zlib
+
+
+class PNGStreamWriter:
+    """Write an RGB PNG a strip of rows at a time.
+
+    Only the compressor state and the strip being written are held in
+    memory, so images far larger than RAM can be written.  The height has to
+    be known up front because it is part of the PNG header.
+
+    Example:
+
+    with PNGStreamWriter("out.png", 30000, 20000) as writer:
+        for strip in strips:
+            writer.write_strip(strip)
+    """
+
+    signature = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, filename, width, height, compression=6):
+        """Initialise PNGStreamWriter instance.
+
+        Args:
+            filename: path of the PNG to write
+            width: width of the image in pixels
+            height: height of the image in pixels
+            compression: zlib compression level
+        """
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compression)
+        self.file = open(filename, 'wb')
+        self.file.write(self.signature)
+        # 8 bits per channel, colour type 2 (RGB), no interlacing
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                              8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    def write_strip(self, strip):
+        """Append the rows of an RGB image as wide as the PNG.
+
+        Rows past the height given in the header are dropped.
+        """
+        rows = min(strip.height, self.height - self.rows_written)
+        raw = strip.convert('RGB').tobytes()
+        stride = self.width * 3
+
+        # Every row starts with its filter type, 0 is no filtering
+        scanlines = b''.join(b''.join([b'\x00', raw[row * stride:
+                                                    (row + 1) * stride]])
+                             for row in range(rows))
+        data = self.compressor.compress(scanlines)
+        if data:
+            self.write_chunk(b'IDAT', data)
+        self.rows_written += rows
+
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+        assert self.rows_written == self.height, \
+            "wrote {} of {} rows".format(self.rows_written, self.height)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
@@ -0,0 +1,16 @@
+import pickle
+from compactsession import CompactSession
+from topkmanager import TopKManager
+
+# Turn a session written by gatherimages.py into one that only finds the
+# best numberWanted images, in order.
+numberWanted = 50
+
+sortableDeque = pickle.load(open("sortable1.srt", "rb"))
+if isinstance(sortableDeque, CompactSession):
+    sortableDeque = sortableDeque.resolved()
+topKManager = TopKManager(sortableDeque, numberWanted)
+print(topKManager.number_of_elements, "images, at most",
+      topKManager.progress[1], "comparisons for the best", topKManager.k)
+
+pickle.dump(topKManager, open("sortable1.srt", "wb"))
@@ -0,0 +1,166 @@
+import mmap
+import os
+import pickle
+import struct
+from array import array
+from compactsession import CompactSession
+from sortingmanager import SortingManager, ActionLog
+
+# A session file is a fixed header, a directory of named sections and then
+# the sections, each aligned to 8 bytes.  The arrays of a CompactSession and
+# of the undo and redo logs are stored raw.  Everything else about the
+# manager, such as the runs being merged, the comparison count and the
+# gallop state, is small and is pickled into the "state" section.
+#
+# Opening a session maps the file and points the arrays at it, so only the
+# pages the current pair and progress need are read.  Arrays are copied out
+# of the mapping the first time they change.
+
+magic = b'SORTMAP1'
+header = struct.Struct('<8sI')
+entry = struct.Struct('<32sQQ')
+
+# Attributes of a SortingManager that are stored in sections of their own,
+# or rebuilt when the session is read
+section_attributes = ('sortableDeque', 'initialRuns', 'undoableActions',
+                      'redoableActions', 'commands', 'memo')
+
+# Attributes of a CompactSession stored in sections or rebuilt
+session_sections = ('offsets', 'blob', 'ids', 'bounds', 'group_ids')
+
+
+def is_session_file(filename):
+    with open(filename, 'rb') as session_file:
+        return session_file.read(len(magic)) == magic
+
+
+def can_write(sm):
+    return (isinstance(sm, SortingManager) and
+            isinstance(sm.sortableDeque, CompactSession))
+
+
+def write_session(filename, sm, token=b''):
+    """Write a SortingManager working on a CompactSession to filename.
+
+    Args:
+        filename: path of the session file
+        sm: SortingManager whose sortableDeque is a CompactSession
+        token: bytes identifying this snapshot, returned by read_session
+    """
+    sessions = {'runs': sm.sortableDeque}
+    if isinstance(sm.initialRuns, CompactSession):
+        sessions['initial'] = sm.initialRuns
+
+    sections = [('offsets', sm.sortableDeque.offsets),
+                ('blob', sm.sortableDeque.blob)]
+    for name, session in sessions.items():
+        sections.append((''.join([name, '.ids']), session.ids))
+        sections.append((''.join([name, '.bounds']), session.bounds))
+    for name in ('undoableActions', 'redoableActions'):
+        log = getattr(sm, name)
+        sections.append((''.join([name, '.codes']), log.codes))
+        sections.append((''.join([name, '.starts']), log.starts))
+
+    state = {'manager': {key: value for key, value in sm.__dict__.items()
+                         if key not in section_attributes and
+                         not callable(value)},
+             'logs': {name: (getattr(sm, name).first,
+                             getattr(sm, name).max_groups)
+                      for name in ('undoableActions', 'redoableActions')},
+             'sessions': {name: {key: value for key, value
+                                 in session.__dict__.items()
+                                 if key not in session_sections}
+                          for name, session in sessions.items()},
+             'token': token}
+    if 'initial' not in sessions:
+        state['manager']['initialRuns'] = sm.initialRuns
+    state['manager']['memo'] = None
+    state['manager']['automaticAnswers'] = []
+    sections.append(('state', pickle.dumps(state)))
+
+    buffers = [memoryview(data).cast('B') for _, data in sections]
+    directory = []
+    position = header.size + entry.size * len(sections)
+    positions = []
+    for (name, _), data in zip(sections, buffers):
+        position = (position + 7) // 8 * 8
+        positions.append(position)
+        directory.append(entry.pack(name.encode('ascii'), position,
+                                    len(data)))
+        position += len(data)
+
+    with open(filename, 'wb') as session_file:
+        session_file.write(header.pack(magic, len(sections)))
+        session_file.write(b''.join(directory))
+        for position, data in zip(positions, buffers):
+            session_file.write(bytes(position - session_file.tell()))
+            session_file.write(data)
+        session_file.flush()
+        os.fsync(session_file.fileno())
+
+
+def read_session(filename):
+    """Map a session file and return (SortingManager, mapping, token)."""
+    with open(filename, 'rb') as session_file:
+        mapping = mmap.mmap(session_file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapping)
+    file_magic, section_count = header.unpack_from(view)
+    if file_magic != magic:
+        raise ValueError("not a session file")
+    sections = {}
+    for index in range(section_count):
+        name, position, length = entry.unpack_from(
+            view, header.size + index * entry.size)
+        sections[name.rstrip(b'\0').decode('ascii')] = \
+            view[position:position + length]
+
+    state = pickle.loads(sections['state'])
+
+    sessions = {}
+    for name, attributes in state['sessions'].items():
+        session = CompactSession.__new__(CompactSession)
+        session.__dict__.update(attributes)
+        session.offsets = sections['offsets'].cast('Q')
+        session.blob = sections['blob']
+        session.ids = sections[''.join([name, '.ids'])].cast('I')
+        session.bounds = sections[''.join([name, '.bounds'])].cast('I')
+        sessions[name] = session
+    group_ids = {group: sessions['runs'].number_of_paths + index
+                 for index, group in enumerate(sessions['runs'].groups)}
+    for session in sessions.values():
+        # The sessions share their tables
+        session.groups = sessions['runs'].groups
+        session.group_ids = group_ids
+
+    sm = SortingManager.__new__(SortingManager)
+    sm.__dict__.update(state['manager'])
+    sm.sortableDeque = sessions['runs']
+    if 'initial' in sessions:
+        sm.initialRuns = sessions['initial']
+    for name, (first, max_groups) in state['logs'].items():
+        log = ActionLog(max_groups)
+        log.codes = sections[''.join([name, '.codes'])]
+        log.starts = sections[''.join([name, '.starts'])].cast('I')
+        log.first = first
+        setattr(sm, name, log)
+    sm.create_commands()
+    return sm, mapping, state['token']
+
+
+def detach_session(sm):
+    """Copy everything a session still reads from its file into memory."""
+    sessions = [sm.sortableDeque]
+    if isinstance(sm.initialRuns, CompactSession):
+        sessions.append(sm.initialRuns)
+    offsets = sm.sortableDeque.offsets
+    blob = sm.sortableDeque.blob
+    if isinstance(offsets, memoryview):
+        offsets = array('Q')
+        offsets.frombytes(sm.sortableDeque.offsets.cast('B'))
+        blob = bytes(blob)
+    for session in sessions:
+        session.make_writable()
+        session.offsets = offsets
+        session.blob = blob
+    sm.undoableActions.make_writable()
+    sm.redoableActions.make_writable()
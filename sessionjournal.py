@@ -0,0 +1,200 @@
+import os
+import pickle
+import struct
+from collections import deque
+from sortingmanager import SortingManager
+from compactsession import CompactSession
+import sessionfile
+
+
+class SessionJournal:
+    """Keep a sorting session on disk as a snapshot plus a decision journal.
+
+    The snapshot holds a session manager, or a bare sortable deque or
+    CompactSession as written by gatherimages.py.  Managers on a
+    CompactSession are kept in the memory mapped format of sessionfile.py so
+    they open without reading the whole file, others are pickled.  Every
+    select, undo and redo is appended to the journal as a single byte and
+    flushed as it happens, so a crash loses nothing and saving costs a byte
+    per decision.  Opening a session replays the journal through the
+    manager.
+
+    Every compact_every events the manager is written out as a new snapshot
+    and the journal is restarted.  Each snapshot is written with a random
+    token that the journal starts with, so a journal is ignored if its
+    snapshot has been replaced.  That covers the program dying between
+    replacing the snapshot and replacing the journal, as well as a fresh
+    snapshot copied over an old session.  Copying a session keeps it
+    together however the copy treats modification times.
+
+    Example:
+
+    journal = SessionJournal("sortable.srt")
+    sm = journal.open()
+    journal.select(0)
+    journal.undo()
+    journal.close()
+    """
+
+    header = struct.Struct('<16s')
+    # Selection 2 is a tie
+    selection_events = {0: b'0', 1: b'1', 2: b't'}
+
+    def __init__(self, filename, compact_every=1000, **manager_options):
+        """Initialise SessionJournal instance.
+
+        Args:
+            filename: path of the snapshot, the journal is stored beside it
+            compact_every: number of events between automatic compactions
+            manager_options: keyword arguments for a SortingManager created
+                from a bare sortable deque or CompactSession
+        """
+        self.filename = filename
+        self.manager_options = manager_options
+        self.journal_filename = ''.join([filename, '.journal'])
+        self.compact_every = compact_every
+        self.events_since_compaction = 0
+        self.journal_file = None
+        self.snapshotMap = None
+        self.sm = None
+        self.token = None
+
+        self.actions = {b'0': lambda: self.sm.select(0),
+                        b'1': lambda: self.sm.select(1),
+                        b'u': lambda: self.sm.undo(),
+                        b'r': lambda: self.sm.redo(),
+                        b't': lambda: self.sm.select(2),
+                        b'A': lambda: self.sm.select(0, automatic=True),
+                        b'B': lambda: self.sm.select(1, automatic=True)}
+
+    def open(self):
+        self.token = None
+        if sessionfile.is_session_file(self.filename):
+            self.sm, self.snapshotMap, self.token = \
+                sessionfile.read_session(self.filename)
+        else:
+            with open(self.filename, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+            if isinstance(snapshot, (deque, CompactSession)):
+                self.sm = SortingManager(snapshot, **self.manager_options)
+            elif isinstance(snapshot, tuple):
+                self.token, self.sm = snapshot
+            else:
+                self.sm = snapshot
+
+        events = self.read_journal()
+        for event in events:
+            action = self.actions.get(bytes([event]))
+            if action is not None:
+                action()
+        self.events_since_compaction = len(events)
+
+        # A snapshot without a token, such as a bare one or a manager
+        # pickled by insertimages.py, is saved straight away.  That gives it
+        # a token and the set up is not repeated next time.
+        if self.token is None:
+            self.compact()
+        elif len(events) == 0:
+            self.start_journal()
+        else:
+            self.journal_file = open(self.journal_filename, 'ab')
+        return self.sm
+
+    def read_journal(self):
+        # A missing journal, or one left over from an older snapshot, holds
+        # nothing that needs replaying.
+        if self.token is None:
+            return b''
+        try:
+            with open(self.journal_filename, 'rb') as journal_file:
+                data = journal_file.read()
+        except FileNotFoundError:
+            return b''
+
+        if len(data) < self.header.size:
+            return b''
+        if self.header.unpack_from(data)[0] != self.token:
+            return b''
+        return data[self.header.size:]
+
+    def start_journal(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+        temporary_filename = ''.join([self.journal_filename, '.tmp'])
+        with open(temporary_filename, 'wb') as journal_file:
+            journal_file.write(self.header.pack(self.token))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_filename, self.journal_filename)
+        self.journal_file = open(self.journal_filename, 'ab')
+
+    def record(self, event):
+        self.journal_file.write(event)
+        self.journal_file.flush()
+        self.events_since_compaction += len(event)
+        if self.events_since_compaction >= self.compact_every:
+            self.compact()
+
+    def automatic_events(self):
+        # Answers the manager's memo gave are journaled as 'A' and 'B', so
+        # replaying doesn't depend on what the memo holds by then.
+        events = bytearray()
+        for answer in getattr(self.sm, 'automaticAnswers', ()):
+            events += b'AB'[answer:answer + 1]
+        return events
+
+    def select(self, selection):
+        # Automatic answers are written together with the decision they
+        # followed
+        self.sm.select(selection)
+        if selection in self.selection_events:
+            events = bytearray(self.selection_events[selection])
+            events += self.automatic_events()
+            self.record(bytes(events))
+
+    def answer_current(self):
+        # A memo attached after opening may already know the question the
+        # session stopped on
+        if hasattr(self.sm, 'answer_current'):
+            self.sm.answer_current()
+            events = self.automatic_events()
+            if events:
+                self.record(bytes(events))
+
+    def undo(self):
+        self.sm.undo()
+        self.record(b'u')
+
+    def redo(self):
+        self.sm.redo()
+        self.record(b'r')
+
+    def compact(self):
+        # Write the new snapshot before restarting the journal, see the class
+        # docstring for why this order is safe.
+        # Sessions on a CompactSession are written in the memory mapped
+        # format of sessionfile, anything else is pickled.
+        temporary_filename = ''.join([self.filename, '.tmp'])
+        self.token = os.urandom(self.header.size)
+        if sessionfile.can_write(self.sm):
+            sessionfile.write_session(temporary_filename, self.sm, self.token)
+        else:
+            with open(temporary_filename, 'wb') as snapshot_file:
+                pickle.dump((self.token, self.sm), snapshot_file)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+
+        # A mapped file can't be replaced on every platform
+        if self.snapshotMap is not None:
+            sessionfile.detach_session(self.sm)
+            self.snapshotMap.close()
+            self.snapshotMap = None
+        os.replace(temporary_filename, self.filename)
+
+        self.start_journal()
+        self.events_since_compaction = 0
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
@@ -1,9 +1,14 @@
 import tkinter.ttk
+import random
 from tklabelimage import TkLabelImage
+from imagecache import ImageCache, Prefetcher
+from thumbnailstore import ThumbnailStore
 from sortingmanager import SortingManager
+from sessionjournal import SessionJournal
+from comparisonmemo import ComparisonMemo
+from layout import determine_layout, find_row_height
+from montage import read_sizes, render_montage, stream_montage
 from PIL import Image
-import pickle
-import random
 
 
 class MainApplication(tkinter.ttk.Frame):
@@ -38,7 +43,7 @@ class MainApplication(tkinter.ttk.Frame):
 
         self.randomButton = tkinter.ttk.Button(self.controlFrame)
         self.randomButton.grid_propagate(False)
-        self.randomButton.configure(text="¯\_(ツ)_/¯  Meh!  Either or.", command=self.random_selection)
+        self.randomButton.configure(text="¯\_(ツ)_/¯  Meh!  Either or.", command=self.tie_selection)
         self.randomButton.grid(row=0, column=0, pady=3, padx=3, sticky="nsew", columnspan=2)
 
         self.statusLabel = tkinter.ttk.Label(self.controlFrame)
@@ -75,7 +80,7 @@ class MainApplication(tkinter.ttk.Frame):
         self.controlFrame.rowconfigure(4, weight=1)
 
         self.label1 = TkLabelImage(self.leftImageFrame)
-        self.label1.image_behaviour('dynamic', True, 500)
+        self.label1.image_behaviour('dynamic', True, 500, True)
         self.label1.grid_propagate(False)
         self.label1.grid(row=0, column=0, sticky="nwse")
         self.leftImageFrame.columnconfigure(0, pad=0, weight=1)
@@ -83,37 +88,60 @@ class MainApplication(tkinter.ttk.Frame):
         self.label1.configure(text="Frame1", anchor="center")
 
         self.label2 = TkLabelImage(self.rightImageFrame)
-        self.label2.image_behaviour('dynamic', True, 500)
+        self.label2.image_behaviour('dynamic', True, 500, True)
         self.label2.grid_propagate(False)
         self.label2.grid(row=0, column=0, sticky="nwse")
         self.rightImageFrame.columnconfigure(0, pad=0, weight=1)
         self.rightImageFrame.rowconfigure(0, pad=0, weight=1)
         self.label2.configure(text="Frame2", anchor="center")
 
+        self.thumbnails = ThumbnailStore(".thumbnails")
+        self.imageCache = ImageCache(256 * 2**20)
+        self.prefetcher = Prefetcher(self.imageCache,
+                                     decoder=self.thumbnails.load)
+        self.label1.set_loader(self.prefetcher.load)
+        self.label2.set_loader(self.prefetcher.load)
+        self.label1.set_preview(self.prefetcher.preview)
+        self.label2.set_preview(self.prefetcher.preview)
+
+        # Resizing is coalesced to at most one render per frame interval
+        self.frameInterval = 16
+        self.resizeTimer = None
+        self.windowSize = None
+
         self.commandList = []
         self.parent.bind("<Configure>", self.resize)
         self.label1.bind("<Button-1>", self.label1click)
         self.label2.bind("<Button-1>", self.label2click)
 
-        self.sortableDeque = pickle.load(open("sortable.srt", "rb"))
-        self.sm = SortingManager(self.sortableDeque)
+        self.journal = SessionJournal("sortable.srt", min_gallop=4,
+                                      scheduler='smallest')
+        self.sm = self.journal.open()
+        # Decisions are remembered across sessions and reshuffles, the memo
+        # is attached after the journal has been replayed and answers what it
+        # can of where the session stopped.
+        self.memo = ComparisonMemo("comparisons.memo")
+        self.memo.attach(self.sm)
+        self.journal.answer_current()
         self.load_images()
 
         self.directoryName = "images/"
 
-    def random_selection(self):
-        true_or_false = random.choice([True, False])
-        if true_or_false is True:
-            self.label1click(None)
+    def tie_selection(self):
+        # Both images are grouped together and compared as one from now on.
+        # Managers that can't group elements pick one at random instead.
+        if hasattr(self.sm, 'tie'):
+            self.journal.select(2)
         else:
-            self.label2click(None)
+            self.journal.select(random.choice([0, 1]))
+        self.load_images()
 
     def label1click(self, event):
-        self.sm.select(0)
+        self.journal.select(0)
         self.load_images()
 
     def label2click(self, event):
-        self.sm.select(1)
+        self.journal.select(1)
         self.load_images()
 
     def load_images(self):
@@ -123,6 +151,14 @@ class MainApplication(tkinter.ttk.Frame):
 
         self.label1.load(images[0])
         self.label2.load(images[1])
+
+        # Decode whatever could be shown after the next click in the
+        # background.  Either image may end up in either label.
+        upcoming = self.sm.upcoming_options()
+        for decode_size in {self.label1.decode_size(),
+                            self.label2.decode_size()}:
+            self.prefetcher.prefetch(upcoming, decode_size)
+
         progress = self.sm.progress
         progress_string = ''.join(['Sorting Progress: ', str(progress[1] - progress[0]), ' out of ', str(progress[1])])
         self.statusLabel.configure(text=''.join([progress_string]))
@@ -132,102 +168,84 @@ class MainApplication(tkinter.ttk.Frame):
             self.generateMontageButton.configure(state=tkinter.DISABLED)
 
     def undo(self):
-        self.sm.undo()
+        self.journal.undo()
         self.load_images()
 
     def redo(self):
-        self.sm.redo()
+        self.journal.redo()
         self.load_images()
 
     def save(self):
-        pickle.dump(self.sortableDeque, open("sortable.srt", "wb"))
+        # Every decision is already journaled, saving folds the journal into
+        # a fresh snapshot.
+        self.journal.compact()
         print("saved")
 
     def resize(self, event):
+        # The root window binding also sees Configure events from every child
+        # widget, and moving the window sends them without a size change.
+        if event.widget is not self.parent:
+            return
+        if (event.width, event.height) == self.windowSize:
+            return
+        self.windowSize = (event.width, event.height)
+
+        if self.resizeTimer is None:
+            self.resizeTimer = self.after(self.frameInterval, self.fill_labels)
+
+    def fill_labels(self):
+        self.resizeTimer = None
         self.label1.fill()
         self.label2.fill()
-        pass
-
-    def determine_layout(self, dimensions, padding, width, maximum_height):
-        return_value = []
-        number_of_images = len(dimensions)
-        start = 0
-        aspect_ratio_sum = 0
-        number_of_images_in_row = 0
-
-        for imm in range(0, number_of_images):
-            aspect = dimensions[imm][0] / dimensions[imm][1]
-            aspect_ratio_sum += aspect
-            number_of_images_in_row += 1
-            height = (width - padding * (number_of_images_in_row + 1)) / aspect_ratio_sum
-            if height < maximum_height:
-                return_value.append([start, imm, height])
-                start = imm + 1
-                aspect_ratio_sum = 0
-                number_of_images_in_row = 0
-        if number_of_images_in_row is not 0:
-            return_value.append([start, number_of_images - 1, maximum_height])
-        return return_value
-
-    def montage(self):
-        padding = 30
-        canvas_size = [1920, 1080]
-        canvas = Image.new("RGB", (1920, 1080), "white")
-        dimensions = []
 
-        image_file_names = self.sm.sorting_state[1]
+    def determine_layout(self, dimensions, padding, width, maximum_height,
+                         engine='greedy'):
+        return determine_layout(dimensions, padding, width, maximum_height,
+                                engine)
 
-        with open('results.txt', 'w') as result_file:
-            for image_file in image_file_names:
-                result_file.write(''.join([image_file, '\n']))
-
-        for image_file in image_file_names:
-            with Image.open(image_file) as im:
-                dimensions.append(im.size)
-
-        total_height = 0
-        row_height = 0
-        while total_height < canvas_size[1]:
-            row_height += 1
-            layout = self.determine_layout(dimensions, padding, canvas_size[0], row_height)
-
-            total_height = padding
-            for row in layout:
-                height = int(row[2])
-                if height is 0:
-                    height = 1
-                total_height += padding + height
+    def montage(self, canvas_size=(1920, 1080), stream=None,
+                layout_engine='greedy'):
+        # Canvases too large to hold in memory are written a row at a time
+        padding = 30
+        if stream is None:
+            stream = canvas_size[0] * canvas_size[1] > 100 * 10**6
 
-        final_row_height = (row_height-1)
+        # Tied images share a line of results, separated by tabs
+        groups = [SortingManager.members(element)
+                  for element in self.sm.sorting_state[1]]
+        image_file_names = [image_file for group in groups
+                            for image_file in group]
 
-        layout = self.determine_layout(dimensions, padding, canvas_size[0], final_row_height)
+        with open('results.txt', 'w') as result_file:
+            for group in groups:
+                result_file.write(''.join(['\t'.join(group), '\n']))
 
-        vertical_position = padding
-        for row in layout:
-            horizontal_position = padding
-            height = int(row[2])
-            if height is 0:
-                height = 1
+        dimensions = read_sizes(image_file_names)
 
-            for image_index in range(row[0], row[1]+1):
-                width = int(height * dimensions[image_index][0] / dimensions[image_index][1])
-                if width is 0:
-                    width = 1
-                print(image_file_names[image_index])
-                print(width, height)
-                image = Image.open(image_file_names[image_index])
-                image = image.resize((width, height), Image.ANTIALIAS)
-                canvas.paste(image, (horizontal_position, vertical_position))
+        final_row_height = find_row_height(dimensions, padding, canvas_size,
+                                           layout_engine)
 
-                horizontal_position += width + padding
+        layout = self.determine_layout(dimensions, padding, canvas_size[0], final_row_height,
+                                       layout_engine)
 
-            vertical_position += height + padding
-        canvas.save("test.png")
+        if stream:
+            stream_montage("test.png", image_file_names, dimensions, layout,
+                           padding, canvas_size, self.thumbnails.directory)
+        else:
+            canvas = Image.new("RGB", tuple(canvas_size), "white")
+            render_montage(canvas, image_file_names, dimensions, layout,
+                           padding, self.thumbnails.directory)
+            canvas.save("test.png")
 
 
 # Manage closing the program cleanly
 def close_program(root_window, frame):
     print("program finished")
+    frame.journal.close()
+    frame.memo.close()
+    frame.label1.shutdown()
+    frame.label2.shutdown()
+    frame.prefetcher.shutdown()
 
     # Destroy needs to be explicitly called
     root_window.destroy()
@@ -1,5 +1,9 @@
 from collections import deque, Counter
+import math
+from array import array
 import itertools
+import struct
+from compactsession import CompactSession
 
 
 class Command:
@@ -41,20 +45,174 @@ class Command:
         self.do()
 
 
-class SortingManager:
-    def __init__(self, sortable_deque):
-        self.sortableDeque = sortable_deque
+class ActionLog:
+    """Store a stack of actions as op-codes packed into a single bytearray.
+
+    Each action is a group of one byte op-codes.  The groups are stored back
+    to back in "codes" while "starts" records the offset each group begins
+    at, so a million actions cost a few megabytes rather than a few million
+    Python objects.  If max_groups is set the oldest groups are dropped once
+    the log grows past it.
 
-        counter = itertools.chain(*self.sortableDeque)
-        self.number_of_elements = sum(1 for _ in counter)
+    Example:
+
+    log = ActionLog()
+    log.push(bytes([1, 3, 4]))
+    log.push(bytes([2]))
 
-        list_of_ones = [0] + [1] * self.number_of_elements
-        self.total_comparisons = self.comparisons_remaining(deque(list_of_ones))
+    log.pop() returns bytes([2]) and len(log) is then 1
+    """
+
+    def __init__(self, max_groups=None):
+        """Initialise ActionLog instance.
+
+        Args:
+            max_groups: maximum number of groups kept, None for no limit
+        """
+        self.codes = bytearray()
+        self.starts = array('I')
+        self.first = 0
+        self.max_groups = max_groups
+
+    def __len__(self):
+        return len(self.starts) - self.first
+
+    def make_writable(self):
+        # A log read from a session file holds memoryviews of it until the
+        # first change
+        if isinstance(self.codes, memoryview):
+            self.codes = bytearray(self.codes)
+            starts = array('I')
+            starts.frombytes(self.starts.cast('B'))
+            self.starts = starts
+
+    def push(self, group):
+        self.make_writable()
+        self.starts.append(len(self.codes))
+        self.codes += group
+        if self.max_groups is not None and len(self) > self.max_groups:
+            self.drop_oldest()
+
+    def pop(self):
+        self.make_writable()
+        start = self.starts.pop()
+        group = bytes(self.codes[start:])
+        del self.codes[start:]
+        return group
+
+    def clear(self):
+        self.codes = bytearray()
+        self.starts = array('I')
+        self.first = 0
+
+    def drop_oldest(self):
+        self.make_writable()
+        # Dropped groups are only skipped over.  They are removed from the
+        # buffers once they make up half of the log so trimming stays cheap.
+        self.first += 1
+        if 2 * self.first >= len(self.starts):
+            if self.first < len(self.starts):
+                offset = self.starts[self.first]
+            else:
+                offset = len(self.codes)
+            del self.codes[:offset]
+            self.starts = array('I', (start - offset for start
+                                      in self.starts[self.first:]))
+            self.first = 0
 
-        self.currentAction = deque()
-        self.undoableActions = deque()
-        self.redoableActions = deque()
 
+class SortingManager:
+    # Op-codes used to record commands in the undo and redo logs
+    MOVE_ELEMENT_FROM_LIST1 = 1
+    MOVE_ELEMENT_FROM_LIST2 = 2
+    MOVE_HEAD_TO_END = 3
+    DELETE_HEAD_LIST = 4
+    # Followed by the previous and the new gallop state
+    SET_GALLOP_STATE = 5
+    PROMOTE_INITIAL_RUN = 6
+    TIE_HEADS = 7
+    # Followed by the elements a finished gallop placed and the comparisons
+    # it took
+    GALLOP_ENDED = 8
+
+    # Gallop state: (run being galloped through or last winning run, streak
+    # of wins or comparisons made while galloping, elements of the run known
+    # to come first or -1 when not galloping, first element known to come
+    # after or -1 while searching exponentially)
+    gallop_record = struct.Struct('<BIii')
+    gallop_cost_record = struct.Struct('<II')
+    merging = (0, 0, -1, -1)
+
+    def __init__(self, sortable_deque, debug=False, max_history=None,
+                 min_gallop=None, scheduler='fifo'):
+        self.sortableDeque = sortable_deque
+        self.debug = debug
+
+        # The 'fifo' scheduler merges runs in the order they are queued.  The
+        # 'smallest' scheduler always merges the two smallest runs, like
+        # building a Huffman tree.  Merged runs never shrink, so they are
+        # kept queued in sortableDeque while the runs it started with are
+        # kept sorted by length in initialRuns.  The two smallest runs are
+        # then always at the front of one or the other.  Ties shrink merged
+        # runs, after which this is only close to the two smallest.
+        self.scheduler = scheduler
+        self.initialRuns = deque()
+        if scheduler == 'smallest':
+            # Runs behind a merge that has already started are left alone
+            if len(self.sortableDeque) > 0 and len(self.sortableDeque[0]) == 0:
+                kept = 1
+            else:
+                kept = 3
+            if isinstance(self.sortableDeque, CompactSession):
+                self.initialRuns = self.sortableDeque.split(kept)
+            else:
+                runs = list(itertools.islice(self.sortableDeque, kept, None))
+                for _ in runs:
+                    self.sortableDeque.pop()
+                self.initialRuns = deque(sorted(runs, key=len))
+
+        # Galloping is off unless min_gallop is set.  After that many wins
+        # in a row by one run, a block of it is placed with an exponential
+        # then binary search instead of one element per comparison.
+        self.min_gallop = min_gallop
+        self.gallopState = self.merging
+        # Elements placed by finished gallops and the comparisons they took,
+        # progress scales the remaining count by how much galloping saves
+        self.gallopPlaced = 0
+        self.gallopComparisons = 0
+
+        # An optional ComparisonMemo.  After each decision, questions it can
+        # already answer are answered straight away as part of the same
+        # undoable action, and the answers are listed in automaticAnswers.
+        self.memo = None
+        self.automaticAnswers = []
+
+        self.number_of_elements = (sum(self.run_lengths(self.sortableDeque)) +
+                                   sum(self.run_lengths(self.initialRuns)))
+
+        self.total_comparisons = self.comparisons_model(
+            [0], [1] * self.number_of_elements)
+
+        self.currentAction = bytearray()
+        self.undoableActions = ActionLog(max_history)
+        self.redoableActions = ActionLog()
+
+        self.create_commands()
+
+        # The remaining comparison count is kept up to date by the commands.
+        # The initial cascade can start from any state, so count it in full
+        # once it has settled.  That cascade sets the session up and is not
+        # undoable.
+        self.remaining_comparisons = 0
+        self.determine_state()
+        self.currentAction = bytearray()
+        self.remaining_comparisons = self.recount_comparisons()
+        self.startingComparisons = self.remaining_comparisons
+        # The count a tie under the 'smallest' scheduler first left as an
+        # estimate, None while the count is exact.  See refresh_comparisons.
+        self.estimatedFrom = None
+
+    def create_commands(self):
         self.move_element_from_list1 = Command(self.move_element_from_list1_do,
                                                self.move_element_from_list1_undo)
         self.move_element_from_list2 = Command(self.move_element_from_list2_do,
@@ -63,7 +221,16 @@ class SortingManager:
                                         self.move_head_to_end_undo)
         self.delete_head_list = Command(self.delete_head_list_do,
                                         self.delete_head_list_undo)
-        self.determine_state()
+        self.promote_initial_run = Command(self.promote_initial_run_do,
+                                           self.promote_initial_run_undo)
+        self.tie_heads = Command(self.tie_heads_do, self.tie_heads_undo)
+        self.commands = {
+            self.MOVE_ELEMENT_FROM_LIST1: self.move_element_from_list1,
+            self.MOVE_ELEMENT_FROM_LIST2: self.move_element_from_list2,
+            self.MOVE_HEAD_TO_END: self.move_head_to_end,
+            self.DELETE_HEAD_LIST: self.delete_head_list,
+            self.PROMOTE_INITIAL_RUN: self.promote_initial_run,
+            self.TIE_HEADS: self.tie_heads}
 
     @staticmethod
     def comparisons_remaining(list_of_lengths):
@@ -91,13 +258,79 @@ class SortingManager:
 
         return comparison_count
 
+    @staticmethod
+    def comparisons_remaining_smallest(list_of_lengths, initial_lengths):
+        merged = deque(list_of_lengths)
+        initial = deque(initial_lengths)
+        comparison_count = 0
+
+        if len(merged) >= 3:
+            a = merged.popleft()
+            b = merged.popleft()
+            c = merged.popleft()
+            comparison_count += b + c - 1
+            merged.append(a + b + c)
+        elif len(merged) > 0:
+            # No merge has started, the output list is empty
+            merged.popleft()
+
+        # Promote initial runs and merge the front two runs exactly the way
+        # schedule_initial_runs does.  Ties can leave merged runs shorter
+        # than the ones queued before them, so this is not always the two
+        # smallest.
+        while len(merged) + len(initial) > 1:
+            while initial and (len(merged) < 2 or initial[0] < merged[1]):
+                merged.appendleft(initial.popleft())
+            a = merged.popleft()
+            b = merged.popleft()
+            comparison_count += a + b - 1
+            merged.append(a + b)
+
+        return comparison_count
+
+    def comparisons_model(self, list_of_lengths, initial_lengths):
+        if self.scheduler == 'smallest':
+            return self.comparisons_remaining_smallest(list_of_lengths,
+                                                       initial_lengths)
+        # Initial runs are only held back by the 'smallest' scheduler, here
+        # they are queued behind the rest.
+        return self.comparisons_remaining(
+            deque(itertools.chain(list_of_lengths, initial_lengths)))
+
+    @staticmethod
+    def run_lengths(runs):
+        if isinstance(runs, CompactSession):
+            return runs.run_lengths()
+        return [len(x) for x in runs]
+
+    def recount_comparisons(self):
+        return self.comparisons_model(self.run_lengths(self.sortableDeque),
+                                      self.run_lengths(self.initialRuns))
+
+    def check_progress(self):
+        """Check the incremental comparison count against a full recount."""
+        if self.estimatedFrom is not None:
+            return
+        recounted = self.recount_comparisons()
+        assert self.remaining_comparisons == recounted, \
+            "remaining comparisons {} != recount {}".format(
+                self.remaining_comparisons, recounted)
+
     def determine_state(self):
-        if self.is_sorted():
-            self.wait_for_action()
-        else:
-            self.determine_action()
+        # Each action the cascade takes can lead to another, they are taken
+        # in a loop as a run's tail can be thousands of moves long
+        while True:
+            if self.initialRuns:
+                self.schedule_initial_runs()
+            if self.is_sorted():
+                self.wait_for_action()
+                return
+            if not self.determine_action():
+                return
 
     def determine_action(self):
+        # Return True if an action was taken and the state needs checking
+        # again
         list0empty = len(self.sortableDeque[0]) == 0
         list1empty = len(self.sortableDeque[1]) == 0
         list2empty = len(self.sortableDeque[2]) == 0
@@ -108,16 +341,16 @@ class SortingManager:
             self.wait_for_action()
         elif state == [False, False, True]:
             self.move_element_from_list1()
-            self.currentAction.append(self.move_element_from_list1)
-            self.determine_state()
+            self.currentAction.append(self.MOVE_ELEMENT_FROM_LIST1)
+            return True
         elif state == [False, True, False]:
             self.move_element_from_list2()
-            self.currentAction.append(self.move_element_from_list2)
-            self.determine_state()
+            self.currentAction.append(self.MOVE_ELEMENT_FROM_LIST2)
+            return True
         elif state == [False, True, True]:
             self.move_head_to_end()
-            self.currentAction.append(self.move_head_to_end)
-            self.determine_state()
+            self.currentAction.append(self.MOVE_HEAD_TO_END)
+            return True
         elif state == [True, False, False]:
             self.wait_for_action()
         elif state == [True, False, True]:
@@ -125,40 +358,68 @@ class SortingManager:
             pass
         elif state == [True, True, False]:
             self.delete_head_list()
-            self.currentAction.append(self.delete_head_list)
-            self.determine_state()
+            self.currentAction.append(self.DELETE_HEAD_LIST)
+            return True
         elif state == [True, True, True]:
             # Unreachable state
             pass
         else:
             pass
+        return False
 
     def wait_for_action(self):
         pass
 
+    def schedule_initial_runs(self):
+        # Only between merges: the output list is empty and the previous
+        # merge's empty input lists have been cleared away.
+        if len(self.sortableDeque[0]) != 0:
+            return
+        if len(self.sortableDeque) >= 2 and len(self.sortableDeque[1]) == 0:
+            return
+
+        # Promoting a run pushes list 2 back into the queue, which keeps the
+        # two smallest of the initial and merged runs as lists 1 and 2.
+        while self.initialRuns and (
+                len(self.sortableDeque) < 3 or
+                len(self.initialRuns[0]) < len(self.sortableDeque[2])):
+            self.promote_initial_run()
+            self.currentAction.append(self.PROMOTE_INITIAL_RUN)
+
+    # Each command adjusts remaining_comparisons by its exact effect on
+    # comparisons_remaining.  Moving an element shortens the current merge by
+    # one comparison.  Rotating a finished merge to the end and deleting the
+    # empty head list together add one, which cancels the -1 that
+    # comparisons_remaining gives a merge with both input lists empty.
     def move_element_from_list1_do(self):
         temp_element = self.sortableDeque[1].popleft()
         self.sortableDeque[0].append(temp_element)
+        self.remaining_comparisons -= 1
 
     def move_element_from_list1_undo(self):
         temp_element = self.sortableDeque[0].pop()
         self.sortableDeque[1].appendleft(temp_element)
+        self.remaining_comparisons += 1
 
     def move_element_from_list2_do(self):
         temp_element = self.sortableDeque[2].popleft()
         self.sortableDeque[0].append(temp_element)
+        self.remaining_comparisons -= 1
 
     def move_element_from_list2_undo(self):
         temp_element = self.sortableDeque[0].pop()
         self.sortableDeque[2].appendleft(temp_element)
+        self.remaining_comparisons += 1
 
     def move_head_to_end_do(self):
         temp_deque = self.sortableDeque.popleft()
         self.sortableDeque.append(temp_deque)
+        self.remaining_comparisons += 1
 
     def move_head_to_end_undo(self):
         temp_deque = self.sortableDeque.pop()
         self.sortableDeque.appendleft(temp_deque)
+        self.remaining_comparisons -= 1
 
     def delete_head_list_do(self):
         self.sortableDeque.popleft()
@@ -166,40 +427,322 @@ class SortingManager:
     def delete_head_list_undo(self):
         self.sortableDeque.appendleft(deque())
 
-    def select(self, selection):
-        if self.is_sorted() is False:
-            self.redoableActions.clear()
-            if selection == 0:
-                self.move_element_from_list1()
-                self.currentAction.append(self.move_element_from_list1)
-            elif selection == 1:
-                self.move_element_from_list2()
-                self.currentAction.append(self.move_element_from_list2)
+    # Promoting a run only happens between merges, where the comparison
+    # count already includes the merge it sets up, so the count is unchanged.
+    def promote_initial_run_do(self):
+        temp_deque = self.initialRuns.popleft()
+        self.sortableDeque.insert(1, temp_deque)
+
+    def promote_initial_run_undo(self):
+        temp_deque = self.sortableDeque[1]
+        del self.sortableDeque[1]
+        self.initialRuns.appendleft(temp_deque)
+
+    # Tied elements are merged into one group that is compared as a unit
+    # from then on.  A group is a tuple of the two tied elements, either of
+    # which may be a group itself.  Placing two elements with one decision
+    # takes two comparisons off the current merge, and the run it makes is
+    # one element shorter in every later merge it joins.
+    def tie_heads_do(self):
+        first = self.sortableDeque[1].popleft()
+        second = self.sortableDeque[2].popleft()
+        self.sortableDeque[0].append((first, second))
+        self.remaining_comparisons -= 2 + self.later_merges()
+        self.estimate_comparisons()
+
+    def tie_heads_undo(self):
+        first, second = self.sortableDeque[0].pop()
+        self.sortableDeque[1].appendleft(first)
+        self.sortableDeque[2].appendleft(second)
+        self.remaining_comparisons += 2 + self.later_merges()
+        self.estimate_comparisons()
+
+    def later_merges(self):
+        # The number of merges the current output run joins after this one.
+        # Runs are merged two at a time from the front of the queue and the
+        # result goes to the back, the order comparisons_remaining counts
+        # in.  Which runs meet doesn't depend on their lengths, so only the
+        # run's position is followed, jumping over the merges ahead of it.
+        # The 'smallest' scheduler can meet runs in another order, where
+        # this is an estimate.
+        count = len(self.sortableDeque) - 2 + len(self.initialRuns)
+        position = count - 1
+        merges = 0
+        while count > 1:
+            ahead = position // 2
+            count -= ahead
+            position -= 2 * ahead
+            if count > 1:
+                merges += 1
+                count -= 1
+                position = count - 1
+        return merges
+
+    def estimate_comparisons(self):
+        if self.scheduler == 'smallest' and self.estimatedFrom is None:
+            self.estimatedFrom = self.remaining_comparisons
+
+    def refresh_comparisons(self):
+        # An estimated count is worked out in full once it has been used for
+        # as many comparisons as there are runs, which keeps recounting to
+        # about one step per comparison however often images tie.
+        if self.estimatedFrom is None:
+            return
+        runs = len(self.sortableDeque) + len(self.initialRuns)
+        used = abs(self.estimatedFrom - self.remaining_comparisons)
+        if self.is_sorted() or used >= runs:
+            self.remaining_comparisons = self.recount_comparisons()
+            self.estimatedFrom = None
+
+    @staticmethod
+    def members(element):
+        """Return the elements of a tie group in order, or [element]."""
+        members = []
+        stack = [element]
+        while stack:
+            element = stack.pop()
+            if isinstance(element, tuple):
+                stack.extend(reversed(element))
+            else:
+                members.append(element)
+        return members
+
+    @staticmethod
+    def representative(element):
+        while isinstance(element, tuple):
+            element = element[0]
+        return element
+
+    def display_name(self, element):
+        # A CompactSession holds ids, which are only turned into paths here
+        element = self.representative(element)
+        if isinstance(self.sortableDeque, CompactSession):
+            return self.sortableDeque.path(element)
+        return element
+
+    def move_from(self, list_number):
+        if list_number == 1:
+            self.move_element_from_list1()
+            self.currentAction.append(self.MOVE_ELEMENT_FROM_LIST1)
+        elif list_number == 2:
+            self.move_element_from_list2()
+            self.currentAction.append(self.MOVE_ELEMENT_FROM_LIST2)
+        else:
+            pass
+
+    def set_gallop_state(self, state):
+        if state != self.gallopState:
+            self.currentAction.append(self.SET_GALLOP_STATE)
+            self.currentAction += self.gallop_record.pack(*self.gallopState)
+            self.currentAction += self.gallop_record.pack(*state)
+            self.gallopState = state
+
+    def end_gallop(self, placed, comparisons):
+        self.currentAction.append(self.GALLOP_ENDED)
+        self.currentAction += self.gallop_cost_record.pack(placed, comparisons)
+        self.gallopPlaced += placed
+        self.gallopComparisons += comparisons
+
+    def records(self, action):
+        # Yield (op-code, previous gallop state, new gallop state), or the
+        # cost of a gallop twice for GALLOP_ENDED
+        position = 0
+        size = self.gallop_record.size
+        while position < len(action):
+            code = action[position]
+            if code == self.SET_GALLOP_STATE:
+                yield (code,
+                       self.gallop_record.unpack_from(action, position + 1),
+                       self.gallop_record.unpack_from(action,
+                                                      position + 1 + size))
+                position += 1 + 2 * size
+            elif code == self.GALLOP_ENDED:
+                cost = self.gallop_cost_record.unpack_from(action,
+                                                           position + 1)
+                yield code, cost, cost
+                position += 1 + self.gallop_cost_record.size
+            else:
+                yield code, None, None
+                position += 1
+
+    def undo_action(self, action):
+        for code, previous_state, _ in reversed(list(self.records(action))):
+            if code == self.SET_GALLOP_STATE:
+                self.gallopState = previous_state
+            elif code == self.GALLOP_ENDED:
+                self.gallopPlaced -= previous_state[0]
+                self.gallopComparisons -= previous_state[1]
+            else:
+                self.commands[code].undo()
+
+    def redo_action(self, action):
+        for code, _, new_state in self.records(action):
+            if code == self.SET_GALLOP_STATE:
+                self.gallopState = new_state
+            elif code == self.GALLOP_ENDED:
+                self.gallopPlaced += new_state[0]
+                self.gallopComparisons += new_state[1]
             else:
-                pass
+                self.commands[code]()
 
+    def merge_runs(self):
+        if self.is_sorted():
+            return None
+        return self.sortableDeque[1], self.sortableDeque[2]
+
+    def same_merge(self, runs):
+        # Runs are compared by identity, a new merge brings new deques
+        current_runs = self.merge_runs()
+        return (runs is not None and current_runs is not None and
+                runs[0] is current_runs[0] and runs[1] is current_runs[1])
+
+    def gallop_probe(self):
+        run, _, known_first, known_after = self.gallopState
+        if known_after < 0:
+            # Probe offsets 0, 1, 3, 7, 15, ... until the run loses
+            probe = max(2 * known_first - 1, known_first)
+            return min(probe, len(self.sortableDeque[run]) - 1)
+        return (known_first + known_after) // 2
+
+    def apply_selection(self, selection):
+        if selection == 2:
+            self.tie_step()
+        elif self.min_gallop is None or selection not in (0, 1):
+            self.move_from(selection + 1)
             self.determine_state()
+        elif self.gallopState[2] >= 0:
+            self.gallop_step(selection)
+        else:
+            self.merge_step(selection)
 
-            if len(self.currentAction) != 0:
-                self.undoableActions.append(self.currentAction)
-                self.currentAction = deque()
+    def merge_step(self, selection):
+        last_winner, streak, _, _ = self.gallopState
+        winner = selection + 1
+        streak = streak + 1 if winner == last_winner else 1
+
+        runs = self.merge_runs()
+        self.move_from(winner)
+        self.determine_state()
+
+        if not self.same_merge(runs):
+            self.set_gallop_state(self.merging)
+        elif streak >= self.min_gallop:
+            self.set_gallop_state((winner, 0, 0, -1))
+        else:
+            self.set_gallop_state((winner, streak, -1, -1))
+
+    def gallop_step(self, selection):
+        run, streak, known_first, known_after = self.gallopState
+        length = len(self.sortableDeque[run])
+        probe = self.gallop_probe()
+
+        # While galloping the streak counts the comparisons made
+        comparisons = streak + 1
+        if selection + 1 == run:
+            known_first = probe + 1
+            if known_first == length:
+                known_after = length
+        else:
+            known_after = probe
+
+        if known_after < 0 or known_first < known_after:
+            self.set_gallop_state((run, comparisons, known_first,
+                                   known_after))
+            return
+
+        # The block is found.  Move it, then the other run's head which is
+        # known to come before the rest of the run.
+        runs = self.merge_runs()
+        for _ in range(known_first):
+            self.move_from(run)
+        placed = known_first
+        if known_first < length:
+            self.move_from(3 - run)
+            placed += 1
+        self.end_gallop(placed, comparisons)
+        self.determine_state()
+
+        if self.same_merge(runs) and known_first >= self.min_gallop:
+            self.set_gallop_state((run, 0, 0, -1))
+        else:
+            self.set_gallop_state(self.merging)
+
+    def tie_step(self):
+        # While galloping the probed element ties with the other run's head,
+        # so everything before the probe comes first.
+        run, _, known_first, _ = self.gallopState
+        if known_first >= 0:
+            for _ in range(self.gallop_probe()):
+                self.move_from(run)
+
+        self.tie_heads()
+        self.currentAction.append(self.TIE_HEADS)
+        self.determine_state()
+        self.set_gallop_state(self.merging)
+
+    def tie(self):
+        """Record that both options are as good as each other."""
+        self.select(2)
+
+    def select(self, selection, automatic=False):
+        # automatic replays an answer the memo gave, so it joins the action
+        # of the decision it followed.
+        self.automaticAnswers = []
+        if self.is_sorted() is False:
+            if automatic:
+                if len(self.undoableActions) >= 1:
+                    self.currentAction = bytearray(self.undoableActions.pop())
+            else:
+                self.redoableActions.clear()
+                if self.memo is not None:
+                    self.memo.record_selection(self.options, selection)
 
+            self.apply_selection(selection)
+            if not automatic:
+                self.answer_known()
 
+            if len(self.currentAction) != 0:
+                self.undoableActions.push(self.currentAction)
+                self.currentAction = bytearray()
+
+    def answer_known(self):
+        while self.memo is not None and not self.is_sorted():
+            options = self.options
+            selection = self.memo.known(options[0], options[1])
+            if selection is None:
+                break
+            self.apply_selection(selection)
+            self.automaticAnswers.append(selection)
+
+    def answer_current(self):
+        """Answer the question on show, and any after it, from the memo.
+
+        Used when a session is opened with a memo.  The answers are given as
+        automatic selections, so they join the last action and are listed in
+        automaticAnswers as in select.
+        """
+        answers = []
+        while self.memo is not None and not self.is_sorted():
+            options = self.options
+            selection = self.memo.known(options[0], options[1])
+            if selection is None:
+                break
+            self.select(selection, automatic=True)
+            answers.append(selection)
+        self.automaticAnswers = answers
 
     def undo(self):
         if len(self.undoableActions) >= 1:
             action_to_undo = self.undoableActions.pop()
-            self.redoableActions.append(action_to_undo)
-            for command_to_undo in action_to_undo.__reversed__():
-                command_to_undo.undo()
+            self.redoableActions.push(action_to_undo)
+            self.undo_action(action_to_undo)
             self.wait_for_action()
 
     def redo(self):
         if len(self.redoableActions) >= 1:
             action_to_redo = self.redoableActions.pop()
-            self.undoableActions.append(action_to_redo)
-            for command_to_redo in action_to_redo:
-                command_to_redo()
+            self.undoableActions.push(action_to_redo)
+            self.redo_action(action_to_redo)
             self.wait_for_action()
 
     def is_sorted(self):
@@ -208,12 +751,68 @@ class SortingManager:
         else:
             return True
 
+    def next_options(self, selection):
+        """Return the options that select(selection) would lead to.
+
+        The selection, the cascade that follows it and any answers the memo
+        gives after it are applied and then reversed, so the session is left
+        as it was.
+        """
+        if self.is_sorted():
+            return None
+
+        saved_action = self.currentAction
+        saved_answers = self.automaticAnswers
+        self.currentAction = bytearray()
+        self.automaticAnswers = []
+        self.apply_selection(selection)
+        self.answer_known()
+        next_options = self.options
+        self.undo_action(self.currentAction)
+        self.currentAction = saved_action
+        self.automaticAnswers = saved_answers
+        return next_options
+
+    def upcoming_options(self):
+        return self.upcoming(self.next_options)
+
+    @staticmethod
+    def upcoming(next_options):
+        """Return everything that could be shown after the next decision.
+
+        Args:
+            next_options: the next_options method of a manager
+        """
+        upcoming = []
+        for selection in (0, 1):
+            options = next_options(selection)
+            if options is not None:
+                for option in options:
+                    if option not in upcoming:
+                        upcoming.append(option)
+        return upcoming
+
+    def __getstate__(self):
+        # The memo holds an open file and is not part of the session
+        state = self.__dict__.copy()
+        state['memo'] = None
+        state['automaticAnswers'] = []
+        return state
+
     @property
     def options(self):
-        if not self.is_sorted():
-            return [self.sortableDeque[1][0], self.sortableDeque[2][0]]
-        else:
+        # A tie group is shown by its first element
+        if self.is_sorted():
             return None
+        elif self.gallopState[2] >= 0:
+            probe = self.gallop_probe()
+            if self.gallopState[0] == 1:
+                pair = [self.sortableDeque[1][probe], self.sortableDeque[2][0]]
+            else:
+                pair = [self.sortableDeque[1][0], self.sortableDeque[2][probe]]
+        else:
+            pair = [self.sortableDeque[1][0], self.sortableDeque[2][0]]
+        return [self.display_name(pair[0]), self.display_name(pair[1])]
 
     @property
     def sorted(self):
@@ -221,13 +820,33 @@ class SortingManager:
 
     @property
     def sorting_state(self):
+        if isinstance(self.sortableDeque, CompactSession):
+            return self.sortableDeque.resolved()
         return self.sortableDeque
 
     @property
     def progress(self):
-        S = [len(x) for x in self.sortableDeque]
-        S1 = self.comparisons_remaining(deque(S))
-        if 0 <= S1 <= self.total_comparisons:
-            return [S1, self.total_comparisons]
-        else:
+        self.refresh_comparisons()
+        if self.debug:
+            self.check_progress()
+        S1 = self.remaining_comparisons
+        # Elements a gallop has already placed are not moved until its block
+        # is found, but no longer need comparing.
+        if self.gallopState[2] > 0:
+            S1 -= self.gallopState[2]
+        if not 0 <= S1 <= self.total_comparisons:
             return [0, self.total_comparisons]
+
+        # The counts model a plain merge, one comparison per element placed.
+        # Galloping places blocks in fewer comparisons, by an amount that
+        # depends on the order of the images.  The rest of the sort is
+        # expected to save as much of the plain merge count as the merges
+        # since the session was set up did, which changes each time a gallop
+        # ends.  The total drops by what has been and is expected to be
+        # saved.
+        done = self.startingComparisons - S1
+        saved = self.gallopPlaced - self.gallopComparisons
+        if done <= 0 or saved == 0 or S1 == 0:
+            return [S1, self.total_comparisons]
+        expected = max(math.ceil(S1 * max(done - saved, 1) / done), 1)
+        return [expected, self.total_comparisons - saved - (S1 - expected)]
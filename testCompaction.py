@@ -0,0 +1,51 @@
+import os
+import pickle
+import random
+import tempfile
+from collections import deque
+from comparisonmemo import ComparisonMemo
+from insertionmanager import InsertionManager
+from sessionjournal import SessionJournal
+from sortingmanager import SortingManager
+from topkmanager import TopKManager
+
+# Sessions are compacted several times with a memo attached the way
+# sortamajig.py attaches it, then reopened and checked against the same
+# decisions made without a journal.
+random.seed(1)
+values = list(range(40))
+random.shuffle(values)
+
+sessions = {
+    'merge': lambda: SortingManager(
+        deque([deque()] + [deque([value]) for value in values])),
+    'top k': lambda: TopKManager(values, 5),
+    'insertion': lambda: InsertionManager(sorted(values[:30]), values[30:]),
+}
+
+with tempfile.TemporaryDirectory() as directory:
+    for name, make_session in sessions.items():
+        filename = os.path.join(directory, 'sortable.srt')
+        with open(filename, 'wb') as snapshot_file:
+            pickle.dump(make_session(), snapshot_file)
+
+        memo = ComparisonMemo(os.path.join(directory, name + '.memo'))
+        journal = SessionJournal(filename, compact_every=5)
+        sm = journal.open()
+        memo.attach(sm)
+        expected = make_session()
+        while not sm.is_sorted():
+            options = sm.options
+            journal.select(0 if options[0] < options[1] else 1)
+        while not expected.is_sorted():
+            options = expected.options
+            expected.select(0 if options[0] < options[1] else 1)
+        journal.close()
+        memo.close()
+
+        reopened = SessionJournal(filename)
+        sm = reopened.open()
+        reopened.close()
+        assert sm.sorting_state == expected.sorting_state, name
+        assert not os.path.exists(filename + '.tmp'), name
+        print(name, 'ok')
@@ -12,7 +12,7 @@ toSort = deque([deque(),
                deque([3]),
                deque([6]),
                deque([7])])
-sm = SortingManager(toSort)
+sm = SortingManager(toSort, debug=True)
 
 print("enter\n1 for option 1\n2 for option 2\n8 for undo\n9 for redo")
 while sm.progress[0] != 0:
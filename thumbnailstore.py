@@ -0,0 +1,135 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from PIL import Image
+from imagecache import fit_image
+
+
+class ThumbnailStore:
+    """Keep reduced decodes of images on disk so later sessions can reuse them.
+
+    Thumbnails are content addressed by the original's absolute path,
+    modification time and file size plus the requested size, so an edited
+    original is never served stale.  Each thumbnail is a fixed header
+    followed by raw pixels, which load() memory maps straight into a PIL
+    image without decoding.  Once the store grows past max_bytes the least
+    recently used thumbnails are deleted.
+
+    Example:
+
+    store = ThumbnailStore(".thumbnails")
+    image = store.load("images/a.jpg", (512, 512))
+    """
+
+    header = struct.Struct('<4s4sIIII')
+    magic = b'THMB'
+
+    # Pixel layouts that PIL can map directly from a buffer.  RGB is stored
+    # padded to RGBX for that reason.
+    stored_modes = {'L': 'L', 'RGB': 'RGBX', 'RGBA': 'RGBA'}
+
+    def __init__(self, directory, max_bytes=2**30):
+        """Initialise ThumbnailStore instance.
+
+        Args:
+            directory: where thumbnails are kept, created if missing
+            max_bytes: size the store is trimmed back to
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size
+                               for entry in os.scandir(directory)
+                               if entry.name.endswith('.thm'))
+
+    def thumbnail_path(self, filename, size):
+        status = os.stat(filename)
+        key = repr((os.path.abspath(filename), status.st_mtime_ns,
+                    status.st_size, tuple(size)))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, ''.join([digest, '.thm']))
+
+    def get(self, filename, size):
+        path = self.thumbnail_path(filename, size)
+        try:
+            with open(path, 'rb') as thumbnail_file:
+                mapped = mmap.mmap(thumbnail_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if len(mapped) < self.header.size:
+            return None
+        magic, mode, width, height, source_width, source_height = \
+            self.header.unpack_from(mapped)
+        if magic != self.magic:
+            return None
+        mode = mode.decode('ascii').strip()
+        pixels = memoryview(mapped)[self.header.size:]
+        image = Image.frombuffer(mode, (width, height), pixels,
+                                 'raw', mode, 0, 1)
+        image.info['source_size'] = (source_width, source_height)
+
+        # The modification time records when a thumbnail was last used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return image
+
+    def put(self, filename, size, image):
+        path = self.thumbnail_path(filename, size)
+        source_width, source_height = image.info.get('source_size',
+                                                     image.size)
+        stored_mode = self.stored_modes.get(image.mode)
+        if stored_mode is None:
+            stored_mode = 'RGBA' if 'A' in image.getbands() else 'RGBX'
+        stored = image.convert(stored_mode)
+
+        temporary_path = ''.join([path, '.', str(threading.get_ident()),
+                                  '.tmp'])
+        with open(temporary_path, 'wb') as thumbnail_file:
+            thumbnail_file.write(self.header.pack(
+                self.magic, stored_mode.ljust(4).encode('ascii'),
+                stored.width, stored.height, source_width, source_height))
+            thumbnail_file.write(stored.tobytes())
+        os.replace(temporary_path, path)
+
+        with self.lock:
+            self.total_bytes += os.path.getsize(path)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def load(self, filename, size):
+        image = self.get(filename, size)
+        if image is None:
+            image = fit_image(filename, size)
+            self.put(filename, size, image)
+        return image
+
+    def evict(self):
+        # Trim to 90% of the limit so eviction does not run on every put
+        # Other processes may share the store and evict at the same time
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.thm'):
+                try:
+                    status = entry.stat()
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        entries.sort()
+        self.total_bytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                # Still mapped, or already removed by another process
+                pass
@@ -1,5 +1,8 @@
 import tkinter.ttk
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageTk
+from imagecache import open_reduced
 
 
 class TkLabelImage(tkinter.ttk.Label):
@@ -10,6 +13,28 @@ class TkLabelImage(tkinter.ttk.Label):
         self.quality = 'low'
         self.refresh_delay = 1000
         self.lock_aspect_ratio = True
+        self.reduced_decode = False
+
+        # Optional callable(filename, size) returning an image that fits in
+        # size, used instead of opening the file directly.
+        self.loader = None
+        self.filename = None
+        self.decode_step = 256
+
+        # Images are decoded on a worker thread and handed back through a
+        # queue that is polled from the Tk event loop.  Every load gets a new
+        # generation number so results of loads that have since been
+        # replaced are thrown away.  Until the image arrives a preview from
+        # the optional callable(filename), or a placeholder, is shown.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.results = queue.Queue()
+        self.generation = 0
+        self.loading = False
+        self.pendingLoad = None
+        self.pollTimer = None
+        self.poll_interval = 15
+        self.preview = None
+        self.placeholder = Image.new("RGB", (200, 200), "grey")
 
         # Initialise timer for dynamic refresh
         self.refreshTimer = self.after(self.refresh_delay,
@@ -23,28 +48,96 @@ class TkLabelImage(tkinter.ttk.Label):
         # Initialise variables to hold images
         self.image = self.default
         self.tk_image = ImageTk.PhotoImage(self.image)
+        self.tkImageMode = self.image.mode
+        self.renderedImage = self.image
+        self.renderedFrame = None
+
+        # The last resized frame of each quality as (image, size, frame)
+        self.frames = {}
 
         # Draw image
         # Note: image will be drawn but not re-sized.  The fill method needs to
         # be called after the label has been drawn.
         self.configure(image=self.tk_image)
 
-    def image_behaviour(self, quality, lock_aspect_ratio, delay=1000):
+    def image_behaviour(self, quality, lock_aspect_ratio, delay=1000,
+                        reduced_decode=False):
         self.quality = quality
         self.lock_aspect_ratio = lock_aspect_ratio
         self.refresh_delay = delay
+        self.reduced_decode = reduced_decode
 
-    def load(self, filename):
-        # Try to load an image.  If it fails use the default.
-        try:
-            self.image = Image.open(filename)
-        except OSError as e:
-            self.image = self.default
-        except AttributeError as e:
-            self.image = self.default
+    def set_loader(self, loader):
+        self.loader = loader
 
+    def set_preview(self, preview):
+        self.preview = preview
+
+    def decode_size(self):
+        # Round the label size up so small resizes reuse the same decode.
+        step = self.decode_step
+        width = -(-max(self.winfo_width(), 1) // step) * step
+        height = -(-max(self.winfo_height(), 1) // step) * step
+        return width, height
+
+    def load(self, filename):
+        # Start loading an image and show a preview until it arrives
+        self.filename = filename
+        self.generation += 1
+        if self.pendingLoad is not None:
+            self.pendingLoad.cancel()
+
+        image = None
+        if self.preview is not None:
+            image = self.preview(filename)
+        self.image = image if image is not None else self.placeholder
+        self.loading = True
         self.fill()
 
+        self.pendingLoad = self.executor.submit(self.decode, filename,
+                                               self.decode_size(),
+                                               self.generation)
+        if self.pollTimer is None:
+            self.pollTimer = self.after(self.poll_interval, self.poll)
+
+    def decode(self, filename, size, generation):
+        # Runs on the worker thread.  Try to load an image.  If it fails for
+        # any reason use the default, a result has to be posted or the label
+        # would wait for it forever.
+        if generation != self.generation:
+            return
+        try:
+            if self.loader is not None:
+                image = self.loader(filename, size)
+            elif self.reduced_decode:
+                image = open_reduced(filename, size)
+            else:
+                image = Image.open(filename)
+                image.load()
+        except Exception:
+            image = self.default
+        self.results.put((generation, image))
+
+    def poll(self):
+        self.pollTimer = None
+        while True:
+            try:
+                generation, image = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                self.loading = False
+                self.pendingLoad = None
+                self.image = image
+                self.fill()
+
+        if self.loading:
+            self.pollTimer = self.after(self.poll_interval, self.poll)
+
+    def shutdown(self):
+        self.generation += 1
+        self.executor.shutdown(wait=False)
+
     def fill(self):
         # Based on the quality setting fill_refresh the image.
         if self.quality == 'dynamic':
@@ -66,6 +159,17 @@ class TkLabelImage(tkinter.ttk.Label):
         label_height = self.winfo_height()
         image_width, image_height = self.image.size
 
+        # A reduced image may have been decoded.  Decode a larger one if it
+        # would have to be enlarged to fill the label and the original has
+        # more detail.
+        source_width, source_height = self.image.info.get('source_size',
+                                                          self.image.size)
+        if (self.filename is not None and not self.loading and
+                label_width > image_width and label_height > image_height and
+                (source_width > image_width or source_height > image_height)):
+            self.load(self.filename)
+            return
+
         # Calculate new image size after resizing based on aspect lock
         if self.lock_aspect_ratio:
             width_ratio = image_width / label_width
@@ -78,17 +182,43 @@ class TkLabelImage(tkinter.ttk.Label):
             new_height = label_height
             new_width = label_width
 
-        # Only resize the image on used for the label if its size changes or
-        # it's forced
+        # Only resize the image on used for the label if its size changes,
+        # the image has changed, such as a preview being replaced, or it's
+        # forced
         if ((new_width != self.tk_image.width()) or
                 (new_height != self.tk_image.height()) or
+                self.renderedImage is not self.image or
                 force_refresh):
 
-            # Resize with appropriate quality
-            if quality == 1:
-                resized_image = self.image.resize((new_width, new_height),
-                                                  Image.ANTIALIAS)
+            resized_image = self.resized_frame(quality,
+                                               (new_width, new_height))
+            if resized_image is self.renderedFrame:
+                return
+
+            # The Tk image is only replaced when its size or mode changes,
+            # otherwise the new frame is pasted into it.
+            if ((new_width == self.tk_image.width()) and
+                    (new_height == self.tk_image.height()) and
+                    resized_image.mode == self.tkImageMode):
+                self.tk_image.paste(resized_image)
             else:
-                resized_image = self.image.resize((new_width, new_height))
-            self.tk_image = ImageTk.PhotoImage(resized_image)
-            self.configure(image=self.tk_image)
+                self.tk_image = ImageTk.PhotoImage(resized_image)
+                self.tkImageMode = resized_image.mode
+                self.configure(image=self.tk_image)
+            self.renderedImage = self.image
+            self.renderedFrame = resized_image
+
+    def resized_frame(self, quality, size):
+        # A delayed high quality refresh, or going back to an earlier size,
+        # often asks for a frame that has just been made.
+        cached = self.frames.get(quality)
+        if cached is not None and cached[0] is self.image and cached[1] == size:
+            return cached[2]
+
+        # Resize with appropriate quality
+        if quality == 1:
+            resized_image = self.image.resize(size, Image.LANCZOS)
+        else:
+            resized_image = self.image.resize(size)
+        self.frames[quality] = (self.image, size, resized_image)
+        return resized_image
@@ -0,0 +1,230 @@
+from collections import deque
+from array import array
+import itertools
+from sortingmanager import SortingManager
+
+
+class TopKManager:
+    """Find and order only the first k elements with a knockout tournament.
+
+    The elements are the leaves of a binary tournament tree.  Building the
+    tree costs n - 1 comparisons and crowns the first element.  Its leaf is
+    then emptied and only the matches on its path to the root are replayed
+    to find the next one, at most ceil(log2(n)) comparisons each.  Finding
+    the top k of 20000 images takes about 20000 + 15 * k comparisons instead
+    of the 270000 of a full sort.  The interface matches SortingManager:
+    select(0) means options[0] comes first.
+
+    Everything that changes is kept in the single array "state": the node
+    being decided, the number of winners found, the number of decisions, the
+    winners and then the tree.  Each decision logs the cells it changed, so
+    undo and redo restore cells rather than replaying matches.
+
+    Example:
+
+    tk = TopKManager([3, 1, 2, 5, 4], 2)
+    while not tk.is_sorted():
+        tk.select(0 if tk.options[0] < tk.options[1] else 1)
+
+    tk.sorting_state[1] then holds 1, 2
+    """
+
+    # Fixed cells at the start of state
+    NODE = 0
+    WINNERS = 1
+    DECISIONS = 2
+    HEADER = 3
+    EMPTY = -1
+
+    def __init__(self, elements, k):
+        """Initialise TopKManager instance.
+
+        Args:
+            elements: iterable of elements, or a sortable deque of runs
+            k: number of elements wanted, in order
+        """
+        elements = list(elements)
+        if elements and isinstance(elements[0], deque):
+            elements = list(itertools.chain(*elements))
+        self.elements = elements
+        self.number_of_elements = len(elements)
+        self.k = max(0, min(k, self.number_of_elements))
+
+        # Leaves are stored from index "leaves" of the tree, node j plays the
+        # winners of nodes 2j and 2j + 1.
+        self.depth = (self.number_of_elements - 1).bit_length()
+        self.leaves = 1 << self.depth
+        self.tree = self.HEADER + self.k
+        self.state = array('i', [self.leaves - 1, 0, 0])
+        self.state.extend(itertools.repeat(self.EMPTY, self.k))
+        self.state.extend(itertools.repeat(self.EMPTY, self.leaves))
+        self.state.extend(range(self.number_of_elements))
+        self.state.extend(itertools.repeat(
+            self.EMPTY, self.leaves - self.number_of_elements))
+
+        # Each decision is a group of (cell, old value, new value) triples
+        self.currentAction = array('i')
+        self.undoableActions = array('i')
+        self.undoableStarts = array('I')
+        self.redoableActions = array('i')
+        self.redoableStarts = array('I')
+
+        if self.number_of_elements > 0:
+            self.total_comparisons = (self.number_of_elements - 1 +
+                                      max(self.k - 1, 0) * self.depth)
+        else:
+            self.total_comparisons = 0
+
+        self.determine_state()
+        self.currentAction = array('i')
+
+    def set(self, cell, value):
+        old = self.state[cell]
+        if old != value:
+            self.currentAction.extend((cell, old, value))
+            self.state[cell] = value
+
+    def building(self):
+        return self.state[self.WINNERS] == 0
+
+    def determine_state(self):
+        # Settle every match that needs no comparison, stopping at the first
+        # one that does or once k winners are known.
+        while not self.is_sorted():
+            node = self.state[self.NODE]
+            if node == 0:
+                self.crown(self.state[self.tree + 1])
+                continue
+
+            left = self.state[self.tree + 2 * node]
+            right = self.state[self.tree + 2 * node + 1]
+            if left != self.EMPTY and right != self.EMPTY:
+                return
+            self.set(self.tree + node, right if left == self.EMPTY else left)
+            self.advance()
+
+    def crown(self, winner):
+        count = self.state[self.WINNERS]
+        self.set(self.HEADER + count, winner)
+        self.set(self.WINNERS, count + 1)
+        if count + 1 < self.k:
+            leaf = self.leaves + winner
+            self.set(self.tree + leaf, self.EMPTY)
+            self.set(self.NODE, leaf >> 1)
+
+    def advance(self):
+        # Building works through every node, replays climb to the root
+        node = self.state[self.NODE]
+        self.set(self.NODE, node - 1 if self.building() else node >> 1)
+
+    def apply_selection(self, selection):
+        node = self.state[self.NODE]
+        self.set(self.tree + node,
+                 self.state[self.tree + 2 * node + selection])
+        self.set(self.DECISIONS, self.state[self.DECISIONS] + 1)
+        self.advance()
+        self.determine_state()
+
+    def undo_action(self, action):
+        for position in range(len(action) - 3, -1, -3):
+            self.state[action[position]] = action[position + 1]
+
+    def redo_action(self, action):
+        for position in range(0, len(action), 3):
+            self.state[action[position]] = action[position + 2]
+
+    @staticmethod
+    def push(actions, starts, action):
+        starts.append(len(actions))
+        actions.extend(action)
+
+    @staticmethod
+    def pop(actions, starts):
+        start = starts.pop()
+        action = actions[start:]
+        del actions[start:]
+        return action
+
+    def select(self, selection):
+        if not self.is_sorted() and selection in (0, 1):
+            del self.redoableActions[:]
+            del self.redoableStarts[:]
+            self.apply_selection(selection)
+            self.push(self.undoableActions, self.undoableStarts,
+                      self.currentAction)
+            self.currentAction = array('i')
+
+    def undo(self):
+        if len(self.undoableStarts) >= 1:
+            action = self.pop(self.undoableActions, self.undoableStarts)
+            self.push(self.redoableActions, self.redoableStarts, action)
+            self.undo_action(action)
+
+    def redo(self):
+        if len(self.redoableStarts) >= 1:
+            action = self.pop(self.redoableActions, self.redoableStarts)
+            self.push(self.undoableActions, self.undoableStarts, action)
+            self.redo_action(action)
+
+    def is_sorted(self):
+        return self.state[self.WINNERS] == self.k
+
+    def next_options(self, selection):
+        if self.is_sorted():
+            return None
+        saved_action = self.currentAction
+        self.currentAction = array('i')
+        self.apply_selection(selection)
+        next_options = self.options
+        self.undo_action(self.currentAction)
+        self.currentAction = saved_action
+        return next_options
+
+    def upcoming_options(self):
+        return SortingManager.upcoming(self.next_options)
+
+    @property
+    def options(self):
+        # A tie group from gatherimages.py is shown by its first element
+        if self.is_sorted():
+            return None
+        node = self.state[self.NODE]
+        return [SortingManager.representative(
+                    self.elements[self.state[self.tree + 2 * node]]),
+                SortingManager.representative(
+                    self.elements[self.state[self.tree + 2 * node + 1]])]
+
+    @property
+    def sorted(self):
+        return self.is_sorted()
+
+    @property
+    def sorting_state(self):
+        # Laid out like a SortingManager session, the winners found so far
+        # make up the first run and every other element is a run of its own.
+        count = self.state[self.WINNERS]
+        winners = self.state[self.HEADER:self.HEADER + count]
+        state = deque([deque(), deque(self.elements[i] for i in winners)])
+        found = set(winners)
+        state.extend(deque([element]) for i, element
+                     in enumerate(self.elements) if i not in found)
+        return state
+
+    def remaining_comparisons(self):
+        if self.is_sorted():
+            return 0
+        count = self.state[self.WINNERS]
+        if count == 0:
+            remaining = self.number_of_elements - 1 - self.state[self.DECISIONS]
+            remaining += (self.k - 1) * self.depth
+        else:
+            # The levels left on the path being replayed, then a full path
+            # for every winner after it.
+            remaining = self.state[self.NODE].bit_length()
+            remaining += (self.k - count - 1) * self.depth
+        return remaining
+
+    @property
+    def progress(self):
+        remaining = min(self.remaining_comparisons(), self.total_comparisons)
+        return [remaining, self.total_comparisons]